@@ -7,12 +7,22 @@ import json
 import time
 import hashlib
 import shutil
+import tarfile
 import threading
 import urllib.parse
 import sqlite3
 import shlex
 import subprocess
-from collections import defaultdict, Counter
+import ctypes
+import struct
+import socket
+import errno
+import stat
+import zlib
+import queue
+import contextlib
+from collections import defaultdict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from pathlib import Path
 
@@ -59,6 +69,13 @@ try:
 except ImportError:
     HAVE_BLAKE3 = False
 
+# ===== zstd (giải nén luồng copy nén; không có thì dùng binary `zstd` local) =====
+try:
+    import zstandard
+    HAVE_ZSTANDARD = True
+except ImportError:
+    HAVE_ZSTANDARD = False
+
 # ===================== CONFIGURATION =====================
 # Server1 (destination)
 SERVER1_ROOT = "/home/syncdata"
@@ -90,13 +107,102 @@ SERVER2_ROOT_ALIASES = None  # ex: ["home_data", "var_data2"]
 USE_MERGE_SUBROOT = False      # True -> SERVER1_ROOT/merge_from_server2/<alias?>/...
 ON_CONFLICT = "version"       # "skip" | "overwrite" | "suffix" | "version"
 
+# SFTP download: nhiều request READ in-flight mỗi file (prefetch) + window channel lớn
+SFTP_PIPELINED = True                 # False: dùng sftp.get() như cũ (để so throughput trong JSON log)
+SFTP_WINDOW_SIZE = 64 * 1024 * 1024   # window channel SSH của phiên SFTP
+SFTP_MAX_PACKET_SIZE = 128 * 1024
+SFTP_REQUEST_SIZE = 64 * 1024         # bytes mỗi request READ (OpenSSH cũ tối đa 64KB, bản mới ~255KB)
+SFTP_MAX_REQUESTS = 128               # số request READ tối đa đang chờ mỗi file
+SFTP_WRITE_BUFFER = 4 * 1024 * 1024   # buffer ghi file local
+# Pool SSH cho copy: N transport độc lập (mỗi cái 1 TCP + 1 thread mã hoá), job chia đều
+SSH_POOL_SIZE = 4                     # 1 = chỉ dùng connection chính như cũ
+SSH_POOL_RETRIES = 1                  # số lần thử lại 1 file khi transport bị rớt giữa chừng
+# File nhỏ: gom batch kéo bằng 1 luồng `tar` qua exec_command thay vì mỗi file 1 lượt SFTP
+TAR_BATCH_ENABLED = True
+TAR_BATCH_MAX_FILE_SIZE = 256 * 1024  # file < ngưỡng này mới vào batch
+TAR_BATCH_MAX_FILES = 2000            # số file tối đa mỗi batch
+TAR_BATCH_MAX_BYTES = 64 * 1024 * 1024
+# Nén trên đường truyền: file nén được kéo qua `zstd -c` ở remote (exec_command), giải nén ở local
+WIRE_COMPRESS = "auto"                # "off" | "auto" (chỉ khi link chậm hơn tốc độ nén) | "always"
+WIRE_COMPRESS_LEVEL = 3
+WIRE_COMPRESS_MIN_SIZE = 1024 * 1024  # file nhỏ hơn: không đáng mở thêm 1 exec_command
+WIRE_COMPRESS_EXTS = {".log", ".csv", ".tsv", ".txt", ".json", ".ndjson", ".xml", ".sql",
+                      ".html", ".htm", ".yaml", ".yml", ".md", ".conf", ".out"}
+WIRE_COMPRESS_SKIP_EXTS = {".gz", ".tgz", ".zst", ".xz", ".bz2", ".lz4", ".zip", ".7z", ".rar",
+                           ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".mp3", ".mp4", ".mkv",
+                           ".mov", ".avi", ".pdf", ".docx", ".xlsx", ".pptx"}
+WIRE_COMPRESS_PROBE_BYTES = 64 * 1024  # extension khác: đọc thử đoạn đầu, nén zlib-1 để ước lượng
+WIRE_COMPRESS_PROBE_RATIO = 0.7        # compressed/raw <= ngưỡng này mới coi là nén được
+WIRE_COMPRESS_LINK_BPS = 100 * 1024 * 1024  # chưa đo được zstd: link SFTP nhanh hơn mức này -> không nén
+WIRE_COMPRESS_REPROBE_EVERY = 50      # auto đang chọn SFTP: cứ N file nén được lại thử zstd 1 file (EWMA theo kịp link); 0 = tắt
+# Nhiều path cùng hash nội dung: tải 1 lần, các path còn lại hardlink từ file vừa tải (không được thì copy local)
+LINK_DUPLICATES = True
+# Hash file ngay lúc copy (cùng algo), đối chiếu hash remote và ghi thẳng row filemeta_local
+COPY_SEED_LOCAL_CACHE = True
+COPY_SEED_BATCH = 500                 # số row mỗi lượt gửi CacheWriter (sync file của lô trước khi ghi row)
+# Lịch copy: lane riêng cho file lớn (không chiếm hết worker), task sắp theo thư mục remote
+COPY_LARGE_FILE_SIZE = 256 * 1024 * 1024  # file >= ngưỡng này vào lane large
+COPY_LARGE_WORKERS = 2                # số worker tối đa cho lane large (phần còn lại cho file nhỏ)
+COPY_BANDWIDTH_LIMIT = 0              # bytes/s trên đường truyền cho toàn bộ copy (token bucket); 0 = không giới hạn
+COPY_BANDWIDTH_BURST = 8 * 1024 * 1024  # dung lượng bucket (bytes)
+COPY_MAX_INFLIGHT_BYTES = 0           # tổng size các file đang tải cùng lúc; 0 = không giới hạn
+# Ghi file tạm rồi rename (không để file dở ở path thật); đẩy xuống đĩa 1 lần cuối vòng copy
+COPY_FSYNC = "syncfs"                 # "syncfs" (mỗi filesystem 1 lần) | "fsync" (từng file + thư mục) | "off"
+# Chỗ trống đĩa đích: mỗi task giữ trước size của nó trên free thực tế trừ lề an toàn, không đủ -> hoãn sang vòng sau
+DISK_ADMISSION_ENABLED = True
+DISK_SAFETY_MARGIN_BYTES = 2 * 1024 * 1024 * 1024  # lề tối thiểu giữ lại trên filesystem đích
+DISK_SAFETY_MARGIN_PCT = 0.05         # hoặc % dung lượng filesystem, lấy giá trị lớn hơn
+PREALLOCATE_MIN_SIZE = 16 * 1024 * 1024  # file >= ngưỡng này được fallocate trước khi ghi (ít phân mảnh); 0 = tắt
+
 # Remote hash performance / budget per cycle (to avoid full scan)
 MAX_WORKERS = 8
 HASH_CHUNK = 1024 * 1024  # 1MB
 REMOTE_HASH_BUDGET_FILES = 500      # max hash N remote files per round
 REMOTE_HASH_BUDGET_BYTES = 5 * 1024 * 1024 * 1024  # 5GB per round (0 = ignore bytes limit)
+# Local scan: số file mỗi chunk bulk-load/ghi (commit do CacheWriter gom, xem CACHE_WRITER_COMMIT_ROWS)
+LOCAL_SCAN_BATCH = 2000
+SQLITE_MAX_VARS = 900  # giữ dưới giới hạn bind params của SQLite cũ (999)
+# Local hash pool: số worker, số job hash tối đa đang chạy/chờ, "thread" | "process"
+LOCAL_HASH_WORKERS = 4
+LOCAL_HASH_INFLIGHT = 16
+LOCAL_HASH_EXECUTOR = "thread"
+# Local walker: số thread scandir song song; bỏ qua liệt kê thư mục có mtime không đổi
+# (sửa nội dung file tại chỗ không đổi mtime thư mục -> full scan định kỳ để bắt lại)
+LOCAL_SCAN_THREADS = 8
+LOCAL_PRUNE_UNCHANGED_DIRS = True
+LOCAL_FULL_SCAN_EVERY = 3600  # giây
+# Local watcher (inotify, Linux): vòng thường chỉ xử lý path thay đổi, full scan đối soát định kỳ
+LOCAL_WATCH_ENABLED = False
+LOCAL_WATCH_RECONCILE_EVERY = 6 * 3600  # giây
+LOCAL_WATCH_MAX_PATHS = 200000          # journal vượt ngưỡng -> coi như overflow, full scan
+# Remote metadata: số row upsert + commit mỗi batch khi đang stream output find
+REMOTE_META_BATCH = 5000
+# Remote listing incremental: chỉ lấy file đổi (ctime) từ vòng trước + subtree của thư mục bị rename; file khác được carry forward last_seen.
+# Full listing (để phát hiện file bị xóa) chạy mỗi REMOTE_FULL_LIST_EVERY giây.
+REMOTE_INCREMENTAL_LIST = True
+REMOTE_FULL_LIST_EVERY = 3600
+REMOTE_INCREMENTAL_OVERLAP = 120  # giây lùi lại so với mốc remote trước (lệch clock, file đang ghi)
+# Remote hash: số kết quả hash ghi (executemany) + commit mỗi lần khi đang stream
+REMOTE_HASH_COMMIT_BATCH = 200
+# Remote hash song song thích ứng: dò nproc/loadavg của server2 và throughput từng sub-batch
+# để tăng/giảm số tiến trình hash (xargs -P) giữa các sub-batch
+REMOTE_HASH_PARALLEL_MIN = 1
+REMOTE_HASH_PARALLEL_MAX = 16
+REMOTE_HASH_PARALLEL_START = 4
+REMOTE_HASH_SUBBATCH_FILES = 100
+REMOTE_HASH_LOAD_HIGH = 0.8  # load ngoài (không tính hash của mình) / nproc vượt ngưỡng -> giảm một nửa
+# Size prefilter: file remote có size không trùng file local nào -> unique ngay, không tốn hash budget
+REMOTE_SIZE_PREFILTER = True
+# Partial hash tier: hash(size + N MiB đầu/giữa/cuối) cho file lớn; remote chỉ full hash khi partial trùng local
+PARTIAL_HASH_ENABLED = True
+PARTIAL_HASH_SEGMENT = 4 * 1024 * 1024      # N
+PARTIAL_HASH_MIN_SIZE = 64 * 1024 * 1024    # file nhỏ hơn -> full hash luôn (phải >= 3*N)
+REMOTE_PARTIAL_BUDGET_FILES = 5000          # max partial-hash N remote files per round
 # Performance / priority when selecting remote files to hash
 REMOTE_HASH_SECONDARY = "size"  # "size" | "mtime"
+# Planner: giữ only_in_2 thành bảng plan_only_in_2, mỗi vòng chỉ tính lại các hash có thay đổi
+PLAN_INCREMENTAL = True
+PLAN_FULL_REBUILD_EVERY = 24 * 3600  # rebuild toàn bộ định kỳ cho chắc
 
 # Logging / Metrics
 TEXTFILE_COLLECTOR_DIR = "/var/lib/node_exporter/textfile_collector"
@@ -131,6 +237,23 @@ EMAIL_SUBJECT_PREFIX = "[Merge Alert] "
 CACHE_DB = "/var/tmp/merge_hash_cache.sqlite"
 # Will automatically select "blake3" if the remote has b3sum, otherwise "sha256"
 PREFERRED_HASH = "blake3" if HAVE_BLAKE3 else "sha256"
+# Schema (PRAGMA user_version). v1: hash/phash lưu BLOB 32 byte, algo lưu id số theo HASH_ALGO_IDS
+# v2: file lưu theo (dir_id, name), root/host intern sang id (bảng path_root, path_dir)
+CACHE_SCHEMA_VERSION = 2
+CACHE_MIGRATE_BATCH = 50000  # số row mỗi lô khi migrate DB cũ (commit từng lô)
+PATH_ID_CACHE_MAX = 200000   # số thư mục giữ id trong RAM (PathIds)
+HASH_ALGO_IDS = {"sha256": 1, "blake3": 2}
+# Connection tới CACHE_DB: 1 connection / thread, giữ suốt process (xem CacheDB)
+CACHE_SYNCHRONOUS = "NORMAL"   # WAL + NORMAL: không hỏng DB khi crash, mất điện chỉ mất vài commit cuối
+CACHE_PAGE_CACHE_MB = 64       # PRAGMA cache_size (mỗi connection)
+CACHE_MMAP_MB = 256            # PRAGMA mmap_size; 0 = tắt mmap
+CACHE_STMT_CACHE = 256         # số câu SQL giữ dạng prepared trên mỗi connection
+CACHE_BUSY_TIMEOUT = 30        # giây chờ khi connection khác đang giữ lock ghi
+# Ghi DB qua 1 thread writer riêng (CacheWriter): producer đẩy lô vào queue, writer group commit
+CACHE_WRITER_THREAD = True       # False: chạy thao tác ghi ngay trên thread gọi (cùng logic group commit)
+CACHE_WRITER_QUEUE = 256         # số lô tối đa chờ trong queue (producer chỉ block khi queue đầy)
+CACHE_WRITER_COMMIT_ROWS = 20000 # commit khi đã gom đủ số row...
+CACHE_WRITER_COMMIT_SECS = 1.0   # ...hoặc lô chưa commit cũ nhất đã chờ quá số giây này
 
 # ====== Scrub (optional) ======
 SCRUB_ENABLED = True
@@ -149,44 +272,618 @@ SCRUB_LIMIT_REMOTE = 3000
 _thread_local = threading.local()
 
 # ===================== DB =====================
+def _ensure_column(db, table, column, decl):
+    cols = {row[1] for row in db.execute(f"PRAGMA table_info({table})")}
+    if column not in cols:
+        db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def _algo_id(algo):
+    """Tên thuật toán -> id số lưu trong cột algo."""
+    return HASH_ALGO_IDS[algo]
+
+def _hash_blob(h):
+    """Hash hex (output hashlib/b3sum/sha256sum) -> bytes để lưu DB; None nếu rỗng/không phải hex."""
+    if h is None or isinstance(h, bytes):
+        return h
+    try:
+        return bytes.fromhex(h)
+    except ValueError:
+        return None
+
+def _hash_hex(b):
+    """Hash trong DB (bytes) -> hex, dùng cho key hash2/only_in_2 và JSON log."""
+    return b.hex() if isinstance(b, bytes) else b
+
+_PLAN_TRIGGERS = ["filemeta_local_plan_ai", "filemeta_local_plan_ad", "filemeta_local_plan_au",
+                  "filemeta_local_plan_bi", "filemeta_remote_plan_ai", "filemeta_remote_plan_ad",
+                  "filemeta_remote_plan_au"]
+
+def _migrate_v1_binary_hash(db):
+    """v1: hash/phash hex TEXT -> BLOB, algo tên -> id số; UPDATE tại chỗ theo lô rowid."""
+    _ensure_column(db, "filemeta_local", "phash", "TEXT")
+    _ensure_column(db, "filemeta_remote", "phash", "TEXT")
+    db.create_function("hash_blob", 1, _hash_blob, deterministic=True)
+    db.create_function("algo_id", 1, lambda a: HASH_ALGO_IDS.get(a, a), deterministic=True)
+    total = 0
+    for table in ("filemeta_local", "filemeta_remote"):
+        key = f"schema_migrate_v1:{table}"
+        last = _state_get(db, key, 0)
+        while True:
+            hi = db.execute(f"""SELECT MAX(rowid) FROM (SELECT rowid FROM {table}
+                                WHERE rowid>? ORDER BY rowid LIMIT ?)""",
+                            (last, CACHE_MIGRATE_BATCH)).fetchone()[0]
+            if hi is None:
+                break
+            total += db.execute(f"""UPDATE {table}
+                                    SET algo=algo_id(algo), hash=hash_blob(hash), phash=hash_blob(phash)
+                                    WHERE rowid>? AND rowid<=?""", (last, hi)).rowcount
+            _state_set(db, key, hi)
+            db.commit()
+            last = hi
+    return total
+
+def _migrate_v2_path_dict(db):
+    """
+    v2: (root, rel) -> (root_id, dir_id, name). Bảng mới *_v2 được chép theo lô rowid
+    (INSERT OR REPLACE -> chạy lại được), xong thì DROP bảng cũ + RENAME trong 1 transaction.
+    """
+    _create_file_tables(db, suffix="_v2")
+    ids = PathIds(db)
+    total = 0
+    for table, host_col in (("filemeta_local", "''"), ("filemeta_remote", "host")):
+        key = f"schema_migrate_v2:{table}"
+        last = _state_get(db, key, 0)
+        while True:
+            rows = db.execute(f"""SELECT rowid, {host_col}, root, rel, size, mtime, algo, hash,
+                                         last_seen, last_hashed, phash
+                                  FROM {table} WHERE rowid>? ORDER BY rowid LIMIT ?""",
+                              (last, CACHE_MIGRATE_BATCH)).fetchall()
+            if not rows:
+                break
+            out = []
+            for _, host, root, rel, *rest in rows:
+                root_id = ids.root(host, root)
+                out.append((root_id, *ids.rel(root_id, rel), *rest))
+            db.executemany(f"""INSERT OR REPLACE INTO {table}_v2
+                               (root_id, dir_id, name, size, mtime, algo, hash, last_seen, last_hashed, phash)
+                               VALUES(?,?,?,?,?,?,?,?,?,?)""", out)
+            last = rows[-1][0]
+            _state_set(db, key, last)
+            db.commit()
+            total += len(rows)
+    if db.in_transaction:
+        db.commit()
+    db.execute("BEGIN")
+    for table in ("filemeta_local", "filemeta_remote"):
+        db.execute(f"DROP TABLE {table}")
+        db.execute(f"ALTER TABLE {table}_v2 RENAME TO {table}")
+    db.commit()
+    return total
+
+def _migrate_cache_schema(db, version):
+    """
+    Migrate DB cũ (user_version = version) lên CACHE_SCHEMA_VERSION, từng bước:
+    - v1: hash BLOB + algo id (tại chỗ);
+    - v2: từ điển thư mục path_root/path_dir (chép sang bảng mới).
+    Mỗi bước commit theo lô CACHE_MIGRATE_BATCH (WAL: reader vẫn đọc được), mốc rowid lưu ở
+    sync_state -> bị ngắt thì lần sau chạy tiếp. Trigger + bảng planner được gỡ, db_init tạo lại.
+    """
+    for name in _PLAN_TRIGGERS:
+        db.execute(f"DROP TRIGGER IF EXISTS {name}")
+    db.execute("DROP TABLE IF EXISTS plan_only_in_2")
+    db.execute("DROP TABLE IF EXISTS plan_dirty")
+    if version < 1:
+        _migrate_v1_binary_hash(db)
+    if version < 2:
+        _migrate_v2_path_dict(db)
+    db.execute("DELETE FROM sync_state WHERE key='plan_sig' OR key LIKE 'schema_migrate_v%'")
+    db.execute(f"PRAGMA user_version={int(CACHE_SCHEMA_VERSION)}")
+    db.commit()
+    # đếm 1 lần trên bảng cuối cùng (mỗi bước chép/sửa cùng các row, cộng dồn sẽ đếm trùng)
+    total = sum(db.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+                for t in ("filemeta_local", "filemeta_remote"))
+    if total:
+        print(f"🗄️ Cache DB migrated to schema v{CACHE_SCHEMA_VERSION}: {total} rows "
+              f"(chạy VACUUM lúc rảnh để thu nhỏ file)")
+
+class PathIds:
+    """
+    Intern đường dẫn: (host, root) -> path_root.id (host '' = local), (root_id, thư mục) -> path_dir.id.
+    Đọc qua connection `db` của thread gọi; id mới được tạo trên connection của CacheWriter
+    (writer.call) để thread gọi không giữ lock ghi. Nếu ghi lỗi/rollback thì bỏ object này.
+    """
+
+    def __init__(self, db, writer=None):
+        self.db = db
+        self.writer = writer
+        self.roots = {}
+        self.dirs = {}
+
+    @staticmethod
+    def _lookup(db, table, cols, key, create):
+        if create:
+            db.execute(f"INSERT OR IGNORE INTO {table}({cols}) VALUES(?,?)", key)
+        a, b = cols.split(", ")
+        row = db.execute(f"SELECT id FROM {table} WHERE {a}=? AND {b}=?", key).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _create_dirs(db, root_id, paths):
+        return [(p, PathIds._lookup(db, "path_dir", "root_id, path", (root_id, p), True)) for p in paths]
+
+    def _get(self, table, cols, key, create):
+        found = self._lookup(self.db, table, cols, key, create and self.writer is None)
+        if found is None and create and self.writer is not None:
+            found = self.writer.call(self._lookup, table, cols, key, True)
+        return found
+
+    def root(self, host, root, create=True):
+        key = (host or "", root)
+        rid = self.roots.get(key)
+        if rid is None:
+            rid = self._get("path_root", "host, root", key, create)
+            if rid is None:
+                return None
+            self.roots[key] = rid
+        return rid
+
+    def _remember(self, key, did):
+        if len(self.dirs) >= PATH_ID_CACHE_MAX:
+            self.dirs.clear()
+        self.dirs[key] = did
+
+    def dir(self, root_id, path, create=True):
+        key = (root_id, path)
+        did = self.dirs.get(key)
+        if did is None:
+            did = self._get("path_dir", "root_id, path", key, create)
+            if did is None:
+                return None
+            self._remember(key, did)
+        return did
+
+    def rel(self, root_id, rel, create=True):
+        """rel -> (dir_id, name); dir_id None nếu thư mục chưa có trong path_dir (create=False)."""
+        path, _, name = rel.rpartition("/")
+        return self.dir(root_id, path, create), name
+
+    def prefetch(self, root_id, rels):
+        """Nạp sẵn dir_id cho thư mục của các rel; thư mục mới được tạo trong 1 lượt writer.call."""
+        missing = []
+        for path in {rel.rpartition("/")[0] for rel in rels}:
+            if (root_id, path) not in self.dirs and self.dir(root_id, path, create=False) is None:
+                missing.append(path)
+        if not missing:
+            return
+        if self.writer is None:
+            created = self._create_dirs(self.db, root_id, missing)
+        else:
+            created = self.writer.call(self._create_dirs, root_id, missing)
+        for path, did in created:
+            self._remember((root_id, path), did)
+
+# Lọc theo root/host qua id đã intern (subquery không tương quan -> SQLite tính 1 lần)
+_LOCAL_ROOT_ID_SQL = "(SELECT id FROM path_root WHERE host='' AND root=?)"
+_HOST_ROOT_IDS_SQL = "(SELECT id FROM path_root WHERE host=?)"
+
+def _rel_sql(t, d="d"):
+    """Biểu thức SQL dựng lại rel từ path_dir.path + name (cần JOIN path_dir {d} ON {d}.id={t}.dir_id)."""
+    return f"(CASE WHEN {d}.path='' THEN {t}.name ELSE {d}.path || '/' || {t}.name END)"
+
+def _create_file_tables(db, suffix=""):
+    db.execute(f"""CREATE TABLE IF NOT EXISTS filemeta_local{suffix}(
+        root_id INTEGER, dir_id INTEGER, name TEXT, size INTEGER, mtime INTEGER,
+        algo INTEGER, hash BLOB, last_seen INTEGER, last_hashed INTEGER, phash BLOB,
+        PRIMARY KEY(dir_id, name, algo)
+    )""")
+    db.execute(f"""CREATE TABLE IF NOT EXISTS filemeta_remote{suffix}(
+        root_id INTEGER, dir_id INTEGER, name TEXT, size INTEGER, mtime INTEGER,
+        algo INTEGER, hash BLOB, last_seen INTEGER, last_hashed INTEGER, phash BLOB,
+        PRIMARY KEY(dir_id, name, algo)
+    )""")
+
+_db_init_lock = threading.Lock()
+_db_initialized = set()
+
 def db_init():
+    """Tạo/migrate schema CACHE_DB. Chỉ chạy 1 lần mỗi process cho mỗi file DB; các lần gọi sau là no-op."""
+    with _db_init_lock:
+        if CACHE_DB in _db_initialized:
+            return
+        _db_init_schema()
+        _db_initialized.add(CACHE_DB)
+
+def _db_init_schema():
     os.makedirs(os.path.dirname(CACHE_DB), exist_ok=True)
     with sqlite3.connect(CACHE_DB) as db:
         db.execute("""PRAGMA journal_mode=WAL;""")
-        db.execute("""CREATE TABLE IF NOT EXISTS filemeta_local(
-            root TEXT, rel TEXT, size INTEGER, mtime INTEGER,
-            algo TEXT, hash TEXT, last_seen INTEGER, last_hashed INTEGER,
-            PRIMARY KEY(root, rel, algo)
+        db.execute("""CREATE TABLE IF NOT EXISTS sync_state(
+            key TEXT PRIMARY KEY, value
+        )""")
+        # Từ điển đường dẫn: root/host -> id, thư mục (rel của thư mục, '' = gốc) -> id
+        db.execute("""CREATE TABLE IF NOT EXISTS path_root(
+            id INTEGER PRIMARY KEY, host TEXT NOT NULL, root TEXT NOT NULL,
+            UNIQUE(host, root)
+        )""")
+        db.execute("""CREATE TABLE IF NOT EXISTS path_dir(
+            id INTEGER PRIMARY KEY, root_id INTEGER NOT NULL, path TEXT NOT NULL,
+            UNIQUE(root_id, path)
         )""")
-        db.execute("""CREATE TABLE IF NOT EXISTS filemeta_remote(
-            host TEXT, root TEXT, rel TEXT, size INTEGER, mtime INTEGER,
-            algo TEXT, hash TEXT, last_seen INTEGER, last_hashed INTEGER,
-            PRIMARY KEY(host, root, rel, algo)
+        fresh = db.execute("""SELECT 1 FROM sqlite_master
+                              WHERE type='table' AND name='filemeta_local'""").fetchone() is None
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        if fresh:
+            db.execute(f"PRAGMA user_version={int(CACHE_SCHEMA_VERSION)}")
+        elif version < CACHE_SCHEMA_VERSION:
+            _migrate_cache_schema(db, version)
+        _create_file_tables(db)
+        db.execute("""CREATE TABLE IF NOT EXISTS dirmeta_local(
+            root TEXT, rel TEXT, parent TEXT, mtime_ns INTEGER, last_seen INTEGER,
+            PRIMARY KEY(root, rel)
         )""")
+        # Planner incremental: plan_only_in_2 = file remote (hash thật) chưa có ở local;
+        # plan_dirty = hash bị đổi/thêm/xoá từ lần plan trước (ghi bởi trigger bên dưới)
+        db.execute("""CREATE TABLE IF NOT EXISTS plan_only_in_2(
+            root_id INTEGER, dir_id INTEGER, name TEXT, algo INTEGER, hash BLOB, size INTEGER,
+            PRIMARY KEY(dir_id, name, algo)
+        )""")
+        db.execute("""CREATE TABLE IF NOT EXISTS plan_dirty(
+            algo INTEGER, hash BLOB, PRIMARY KEY(algo, hash)
+        ) WITHOUT ROWID""")
+        for table, side in (("filemeta_local", "local"), ("filemeta_remote", "remote")):
+            db.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_plan_ai AFTER INSERT ON {table}
+                WHEN NEW.hash IS NOT NULL
+                BEGIN INSERT INTO plan_dirty VALUES(NEW.algo, NEW.hash) ON CONFLICT DO NOTHING; END""")
+            db.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_plan_ad AFTER DELETE ON {table}
+                WHEN OLD.hash IS NOT NULL
+                BEGIN INSERT INTO plan_dirty VALUES(OLD.algo, OLD.hash) ON CONFLICT DO NOTHING; END""")
+            # đổi hash, hoặc row "sống lại" (đã stale ở lần plan trước, nay được thấy lại)
+            db.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_plan_au AFTER UPDATE OF hash, last_seen ON {table}
+                WHEN OLD.hash IS NOT NEW.hash OR (NEW.hash IS NOT NULL AND OLD.last_seen <
+                     (SELECT value FROM sync_state WHERE key='plan_cutoff:{side}'))
+                BEGIN
+                    INSERT INTO plan_dirty SELECT OLD.algo, OLD.hash WHERE OLD.hash IS NOT NULL
+                    ON CONFLICT DO NOTHING;
+                    INSERT INTO plan_dirty SELECT NEW.algo, NEW.hash WHERE NEW.hash IS NOT NULL
+                    ON CONFLICT DO NOTHING;
+                END""")
+        # INSERT OR REPLACE (local re-hash) không bắn trigger DELETE -> ghi lại hash cũ trước khi bị thay
+        db.execute("""CREATE TRIGGER IF NOT EXISTS filemeta_local_plan_bi BEFORE INSERT ON filemeta_local
+            BEGIN
+                INSERT INTO plan_dirty
+                SELECT algo, hash FROM filemeta_local
+                WHERE dir_id=NEW.dir_id AND name=NEW.name AND algo=NEW.algo AND hash IS NOT NULL
+                ON CONFLICT DO NOTHING;
+            END""")
 
     with sqlite3.connect(CACHE_DB) as db:
         db.execute("CREATE INDEX IF NOT EXISTS idx_local_algo_hash ON filemeta_local(algo, hash)")
         db.execute("CREATE INDEX IF NOT EXISTS idx_local_last_seen ON filemeta_local(last_seen)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_local_root_algo_size ON filemeta_local(root_id, algo, size)")
         db.execute("CREATE INDEX IF NOT EXISTS idx_remote_algo_hash ON filemeta_remote(algo, hash)")
         db.execute("CREATE INDEX IF NOT EXISTS idx_remote_last_seen ON filemeta_remote(last_seen)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_plan_algo_hash ON plan_only_in_2(algo, hash)")
+        # partial index chỉ chứa file còn cần hash, đã sắp sẵn theo thứ tự ưu tiên của budget
+        secondary = "mtime" if REMOTE_HASH_SECONDARY == "mtime" else "size"
+        db.execute(f"""CREATE INDEX IF NOT EXISTS idx_remote_hash_todo_{secondary}
+                       ON filemeta_remote(algo, {_REMOTE_STALE_RANK_SQL}, {secondary} DESC)
+                       WHERE {_REMOTE_NEEDS_HASH_SQL}""")
+
+# Kiểu row cho các thao tác bulk của CacheDB (hash/phash là BLOB, algo là id số)
+LocalFileRow = tuple[int, int, str, int, int, int, bytes | None, bytes | None, int, int | None]
+# (root_id, dir_id, name, size, mtime, algo, hash, phash, last_seen, last_hashed)
+RemoteMetaRow = tuple[int, int, str, int, int, int, int]
+# (root_id, dir_id, name, size, mtime, algo, last_seen)
+FileKeyRow = tuple[int, str, int]
+# (dir_id, name, algo)
+
+class CacheDB:
+    """
+    Truy cập CACHE_DB qua 1 connection sống suốt process cho mỗi thread (lấy bằng cache_db()).
+    - Schema init/migrate đúng 1 lần (db_init), không chạy lại DDL mỗi hàm.
+    - PRAGMA theo connection: synchronous, cache_size, mmap_size, temp_store.
+    - Câu SQL lặp lại dùng lại prepared statement (cached_statements của sqlite3).
+    Dùng như connection: `with cache_db() as db:` commit khi ra khỏi block, rollback nếu lỗi.
+    Không chia sẻ object giữa các thread.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=CACHE_BUSY_TIMEOUT,
+                                    cached_statements=CACHE_STMT_CACHE)
+        self.conn.execute(f"PRAGMA synchronous={CACHE_SYNCHRONOUS}")
+        self.conn.execute(f"PRAGMA cache_size={-int(CACHE_PAGE_CACHE_MB * 1024)}")
+        self.conn.execute(f"PRAGMA mmap_size={int(CACHE_MMAP_MB) * 1024 * 1024}")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self.conn.__exit__(exc_type, exc, tb)
+
+    def execute(self, sql, params=()):
+        return self.conn.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        return self.conn.executemany(sql, rows)
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    # ---- local ----
+    def upsert_local_files(self, rows: list[LocalFileRow]):
+        if rows:
+            self.conn.executemany("""INSERT OR REPLACE INTO filemeta_local
+                (root_id, dir_id, name, size, mtime, algo, hash, phash, last_seen, last_hashed)
+                VALUES(?,?,?,?,?,?,?,?,?,?)""", rows)
+
+    def touch_local_files(self, last_seen: int, keys: list[FileKeyRow]):
+        if keys:
+            self.conn.executemany("UPDATE filemeta_local SET last_seen=? WHERE dir_id=? AND name=? AND algo=?",
+                                  [(last_seen, *k) for k in keys])
+
+    def set_local_phashes(self, rows: list[tuple[bytes, int, str, int]]):
+        """rows: (phash, dir_id, name, algo)"""
+        if rows:
+            self.conn.executemany("UPDATE filemeta_local SET phash=? WHERE dir_id=? AND name=? AND algo=?", rows)
+
+    def set_local_hashes(self, rows: list[tuple[bytes | None, bytes | None, int | None, int, int, str, int]]):
+        """rows: (hash, phash, last_hashed, last_seen, dir_id, name, algo) — dùng cho scrub."""
+        if rows:
+            self.conn.executemany("""UPDATE filemeta_local SET hash=?, phash=?, last_hashed=?, last_seen=?
+                                     WHERE dir_id=? AND name=? AND algo=?""", rows)
+
+    def delete_local_files(self, keys: list[tuple[int, str]]):
+        """keys: (dir_id, name) — mọi algo."""
+        if keys:
+            self.conn.executemany("DELETE FROM filemeta_local WHERE dir_id=? AND name=?", keys)
+
+    def upsert_dir_mtimes(self, rows: list[tuple[str, str, str, int, int]]):
+        """rows: (root, rel, parent, mtime_ns, last_seen) -> dirmeta_local"""
+        if rows:
+            self.conn.executemany("""INSERT OR REPLACE INTO dirmeta_local(root, rel, parent, mtime_ns, last_seen)
+                                     VALUES(?,?,?,?,?)""", rows)
+
+    # ---- remote ----
+    def upsert_remote_meta(self, rows: list[RemoteMetaRow]):
+        """Upsert metadata; size/mtime đổi => xoá hash/last_hashed/phash để buộc re-hash."""
+        if rows:
+            self.conn.executemany("""
+            INSERT INTO filemeta_remote(root_id, dir_id, name, size, mtime, algo, hash, last_seen, last_hashed)
+            VALUES(?,?,?,?,?,?,NULL,?,NULL)
+            ON CONFLICT(dir_id, name, algo) DO UPDATE SET
+            size=excluded.size,
+            mtime=excluded.mtime,
+            last_seen=excluded.last_seen,
+            -- nếu metadata đổi => làm rỗng hash và last_hashed để buộc re-hash
+            hash = CASE
+                WHEN filemeta_remote.size != excluded.size OR filemeta_remote.mtime != excluded.mtime
+                THEN NULL
+                ELSE filemeta_remote.hash
+            END,
+            last_hashed = CASE
+                WHEN filemeta_remote.size != excluded.size OR filemeta_remote.mtime != excluded.mtime
+                THEN NULL
+                ELSE filemeta_remote.last_hashed
+            END,
+            phash = CASE
+                WHEN filemeta_remote.size != excluded.size OR filemeta_remote.mtime != excluded.mtime
+                THEN NULL
+                ELSE filemeta_remote.phash
+            END
+            """, rows)
+
+    def set_remote_hashes(self, rows: list[tuple[bytes, int, int, str, int]]):
+        """rows: (hash, last_hashed, dir_id, name, algo)"""
+        if rows:
+            self.conn.executemany("""UPDATE filemeta_remote SET hash=?, last_hashed=?
+                                     WHERE dir_id=? AND name=? AND algo=?""", rows)
+
+    def set_remote_phashes(self, rows: list[tuple[bytes, int, str, int]]):
+        """rows: (phash, dir_id, name, algo)"""
+        if rows:
+            self.conn.executemany("UPDATE filemeta_remote SET phash=? WHERE dir_id=? AND name=? AND algo=?", rows)
+
+def cache_db():
+    """CacheDB của thread hiện tại (tạo lần đầu; tạo lại nếu CACHE_DB đổi)."""
+    cdb = getattr(_thread_local, "cache_db", None)
+    if cdb is None or cdb.path != CACHE_DB:
+        db_init()
+        if cdb is not None:
+            cdb.close()
+        cdb = _thread_local.cache_db = CacheDB(CACHE_DB)
+    return cdb
+
+class CacheWriter:
+    """
+    Thread ghi DB duy nhất. Producer (scan/hash local, ingest hash remote, scrub) gọi
+    submit(fn, *args): fn(db, *args) chạy trên connection của writer theo đúng thứ tự FIFO,
+    queue có giới hạn CACHE_WRITER_QUEUE nên producer chỉ block khi writer tụt lại xa.
+    Nhiều lô gom vào 1 transaction, commit khi đủ CACHE_WRITER_COMMIT_ROWS row hoặc quá
+    CACHE_WRITER_COMMIT_SECS -> producer không bao giờ chờ fsync.
+    flush(): barrier — trả về khi mọi thao tác submit trước đó đã commit (dùng trước khi đọc
+    lại dữ liệu vừa ghi, vd compute_planned). Lỗi ghi: writer rollback, bỏ các lô còn lại tới
+    barrier kế tiếp và ném lỗi ra ở submit()/flush() của producer.
+    CACHE_WRITER_THREAD=False: cùng API nhưng chạy ngay trên thread gọi.
+    """
+
+    def __init__(self, threaded=None):
+        self.path = CACHE_DB
+        self.error = None
+        self.ops = self.rows = self.commits = 0
+        self._pending = 0
+        self._since = None
+        self._thread = None
+        if CACHE_WRITER_THREAD if threaded is None else threaded:
+            self._q = queue.Queue(maxsize=max(1, int(CACHE_WRITER_QUEUE)))
+            self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+            self._thread.start()
+
+    def _apply(self, db, kind, fn, args, weight):
+        """Chạy 1 item trên connection của writer; trả về kết quả fn (nếu có)."""
+        result = None
+        if fn is not None:
+            result = fn(db, *args)
+            self.ops += 1
+            self._pending += weight
+            if self._since is None:
+                self._since = time.monotonic()
+        if self._since is not None and (kind != "op" and kind != "call"
+                                        or self._pending >= CACHE_WRITER_COMMIT_ROWS
+                                        or time.monotonic() - self._since >= CACHE_WRITER_COMMIT_SECS):
+            db.commit()
+            self.commits += 1
+            self.rows += self._pending
+            self._pending, self._since = 0, None
+        return result
+
+    def _fail(self, db, e):
+        self.error = e
+        self._pending, self._since = 0, None
+        try:
+            db.conn.rollback()
+        except Exception:
+            pass
+
+    def _run(self):
+        db = cache_db()
+        while True:
+            wait_s = None
+            if self._since is not None:
+                wait_s = max(0.0, self._since + CACHE_WRITER_COMMIT_SECS - time.monotonic())
+            try:
+                kind, fn, args, weight, reply = self._q.get(timeout=wait_s)
+            except queue.Empty:
+                kind, fn, args, weight, reply = "commit", None, (), 0, None
+            result = None
+            if self.error is None:
+                try:
+                    result = self._apply(db, kind, fn, args, weight)
+                except Exception as e:
+                    self._fail(db, e)
+            if reply is not None:
+                if self.error is not None:
+                    reply.set_exception(self.error)
+                    if kind in ("flush", "stop"):
+                        self.error = None  # các lô trước barrier đã bị bỏ -> nhận việc mới
+                else:
+                    reply.set_result(result)
+            if kind == "stop":
+                return
+
+    def _send(self, kind, fn, args, weight, wait_reply):
+        if self._thread is None:
+            db = cache_db()
+            try:
+                return self._apply(db, kind, fn, args, weight)
+            except Exception as e:
+                self._fail(db, e)
+                self.error = None
+                raise
+        reply = Future() if wait_reply else None
+        self._q.put((kind, fn, args, weight, reply))
+        return reply.result() if reply is not None else None
+
+    def submit(self, fn, *args, weight=1):
+        """Xếp fn(db, *args) vào queue (không chờ). weight: số row, dùng cho ngưỡng group commit."""
+        if self.error is not None:
+            self.flush()
+        self._send("op", fn, args, weight, False)
+
+    def call(self, fn, *args):
+        """Như submit nhưng chờ và trả về kết quả của fn (không ép commit)."""
+        return self._send("call", fn, args, 0, True)
+
+    def flush(self):
+        """Barrier: chờ mọi thao tác trước đó đã commit; ném lỗi ghi (nếu có)."""
+        self._send("flush", None, (), 0, True)
+
+    def close(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._send("stop", None, (), 0, True)
+            self._thread.join()
+        elif self._thread is None:
+            self.flush()
+
+_cache_writer = None
+_cache_writer_lock = threading.Lock()
+
+def cache_writer():
+    """CacheWriter dùng chung của process (tạo lần đầu; tạo lại nếu CACHE_DB đổi)."""
+    global _cache_writer
+    with _cache_writer_lock:
+        if _cache_writer is None or _cache_writer.path != CACHE_DB:
+            if _cache_writer is not None:
+                _cache_writer.close()
+            db_init()
+            _cache_writer = CacheWriter()
+        return _cache_writer
 
 def _now():
     return int(time.time())
 
+def _state_get(db, key, default=None):
+    row = db.execute("SELECT value FROM sync_state WHERE key=?", (key,)).fetchone()
+    return row[0] if row else default
+
+def _state_set(db, key, value):
+    db.execute("INSERT OR REPLACE INTO sync_state(key, value) VALUES(?,?)", (key, value))
+
 # ===================== Hash helpers =====================
 def _hash_new(algo):
     return blake3.blake3() if (algo == "blake3" and HAVE_BLAKE3) else hashlib.sha256()
 
-def compute_hash_local(path, algo, chunk_size=HASH_CHUNK):
-    h = _hash_new(algo)
-    size = None
-    try:
-        size = os.path.getsize(path)
-    except Exception:
-        pass
+def _needs_partial(size):
+    return PARTIAL_HASH_ENABLED and size is not None and size >= PARTIAL_HASH_MIN_SIZE
+
+def _partial_segments(size):
+    """3 đoạn [start, end) dùng cho partial hash: đầu, giữa, cuối (không chồng nhau khi size >= 3N)."""
+    n = PARTIAL_HASH_SEGMENT
+    mid = (size - n) // 2
+    return [(0, n), (mid, mid + n), (size - n, size)]
+
+class ContentHasher:
+    """
+    Hash tăng dần theo luồng bytes (đọc file, hoặc bytes đang copy về): full + partial cùng lúc.
+    partial = hash(b"<size>\\n" + 3 đoạn _partial_segments) — cùng công thức với lệnh partial phía remote.
+    """
 
+    def __init__(self, algo, size):
+        self.h = _hash_new(algo)
+        self.ph = None
+        self.segs = []
+        self.pos = 0
+        if _needs_partial(size):
+            self.ph = _hash_new(algo)
+            self.ph.update(f"{size}\n".encode())
+            self.segs = _partial_segments(size)
+
+    def update(self, data):
+        self.h.update(data)
+        pos, end = self.pos, self.pos + len(data)
+        for a, b in self.segs:
+            lo, hi = max(a, pos), min(b, end)
+            if lo < hi:
+                self.ph.update(data[lo - pos:hi - pos])
+        self.pos = end
+
+    def hexdigests(self):
+        """(full_hash, partial_hash|None)"""
+        return self.h.hexdigest(), (self.ph.hexdigest() if self.ph else None)
+
+def compute_hashes_local(path, algo, chunk_size=HASH_CHUNK, progress=True):
+    """Đọc file 1 lần, trả (full_hash, partial_hash|None) — xem ContentHasher."""
     f = open(path, 'rb')
-    if USE_TQDM and size:
+    size = os.fstat(f.fileno()).st_size
+    hasher = ContentHasher(algo, size)
+
+    if USE_TQDM and size and progress:
         from tqdm import tqdm
         with f, tqdm(total=size, unit="B", unit_scale=True, desc=f"🔐 {os.path.basename(path)}",
                      dynamic_ncols=True, leave=False) as bar:
@@ -194,7 +891,7 @@ def compute_hash_local(path, algo, chunk_size=HASH_CHUNK):
                 data = f.read(chunk_size)
                 if not data:
                     break
-                h.update(data)
+                hasher.update(data)
                 bar.update(len(data))
     else:
         with f:
@@ -202,87 +899,620 @@ def compute_hash_local(path, algo, chunk_size=HASH_CHUNK):
                 data = f.read(chunk_size)
                 if not data:
                     break
-                h.update(data)
-    return h.hexdigest()
+                hasher.update(data)
+    return hasher.hexdigests()
+
+def compute_hash_local(path, algo, chunk_size=HASH_CHUNK, progress=True):
+    return compute_hashes_local(path, algo, chunk_size, progress)[0]
+
+def compute_partial_hash_local(path, algo):
+    """Chỉ partial hash (seek 3 đoạn) — dùng bù phash cho row cũ mà không đọc lại cả file."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not _needs_partial(size):
+            return None
+        ph = _hash_new(algo)
+        ph.update(f"{size}\n".encode())
+        for a, b in _partial_segments(size):
+            f.seek(a)
+            remaining = b - a
+            while remaining > 0:
+                data = f.read(min(HASH_CHUNK, remaining))
+                if not data:
+                    break
+                ph.update(data)
+                remaining -= len(data)
+    return ph.hexdigest()
+
+def _hash_local_job(path, algo, mode="full"):
+    """Chạy trong worker: trả (hash|None, phash|None, bytes, seconds, worker_name).
+    mode="partial": chỉ tính phash (hash=None)."""
+    if LOCAL_HASH_EXECUTOR == "process":
+        worker = f"pid-{os.getpid()}"
+    else:
+        worker = threading.current_thread().name
+    t0 = time.time()
+    try:
+        if mode == "partial":
+            h, ph = None, compute_partial_hash_local(path, algo)
+            nbytes = 3 * PARTIAL_HASH_SEGMENT if ph else 0
+        else:
+            h, ph = compute_hashes_local(path, algo, progress=False)
+            nbytes = os.path.getsize(path)
+    except Exception:
+        h, ph, nbytes = None, None, 0
+    return h, ph, nbytes, time.time() - t0, worker
+
+class LocalHashPool:
+    """
+    Pool hash file local song song (thread hoặc process) với hàng đợi in-flight có giới hạn.
+    submit() trả về các kết quả đã xong [(key, hash, phash)], để thread gọi (DB writer) tự ghi DB;
+    block khi đủ `max_inflight` job nên RAM không phụ thuộc số file dirty.
+    """
+
+    def __init__(self, algo, workers=None, max_inflight=None, label="local-hash"):
+        self.algo = algo
+        self.label = label
+        self.workers = max(1, int(workers or LOCAL_HASH_WORKERS))
+        self.max_inflight = max(self.workers, int(max_inflight or LOCAL_HASH_INFLIGHT))
+        if LOCAL_HASH_EXECUTOR == "process":
+            self._ex = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self._ex = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=label)
+        self._inflight = {}
+        self._stats = defaultdict(lambda: [0, 0, 0.0])  # worker -> [files, bytes, seconds]
+        self._t0 = time.time()
+
+    def _collect(self, block):
+        if not self._inflight:
+            return []
+        done, _ = wait(list(self._inflight), timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        out = []
+        for fut in done:
+            key = self._inflight.pop(fut)
+            h, ph, nbytes, secs, worker = fut.result()
+            st = self._stats[worker]
+            st[0] += 1; st[1] += nbytes; st[2] += secs
+            out.append((key, h, ph))
+        return out
+
+    def submit(self, key, path, mode="full"):
+        done = []
+        while len(self._inflight) >= self.max_inflight:
+            done.extend(self._collect(block=True))
+        fut = self._ex.submit(_hash_local_job, path, self.algo, mode)
+        self._inflight[fut] = key
+        done.extend(self._collect(block=False))
+        return done
+
+    def drain(self):
+        done = []
+        while self._inflight:
+            done.extend(self._collect(block=True))
+        return done
+
+    def close(self):
+        self.drain()
+        self._ex.shutdown(wait=True)
+        self.report()
+
+    def report(self):
+        """In throughput từng worker để chọn LOCAL_HASH_WORKERS phù hợp."""
+        if not self._stats:
+            return
+        wall = max(time.time() - self._t0, 1e-6)
+        total_files = sum(v[0] for v in self._stats.values())
+        total_bytes = sum(v[1] for v in self._stats.values())
+        print(f"[{self.label}] {self.workers} workers: {total_files} files, "
+              f"{_fmt_bytes(total_bytes)} in {wall:.1f}s ({_fmt_bytes(total_bytes / wall)}/s)")
+        for worker in sorted(self._stats):
+            files, nbytes, secs = self._stats[worker]
+            rate = nbytes / secs if secs > 0 else 0.0
+            print(f"[{self.label}]   {worker}: {files} files, {_fmt_bytes(nbytes)}, "
+                  f"busy {secs:.1f}s ({_fmt_bytes(rate)}/s)")
 
 # ===================== Local scan =====================
-def scan_local_metadata(root):
+def _iter_batches(iterable, size):
+    """Gom iterator thành các list tối đa `size` phần tử (giữ RAM cố định)."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _parent_rel(rel):
+    return rel.rpartition("/")[0]
+
+def _ancestors(rel):
+    """Các thư mục cha của rel, gần nhất trước ('' không tính)."""
+    d = _parent_rel(rel)
+    while d:
+        yield d
+        d = _parent_rel(d)
+
+def _is_logs_rel(rel):
+    return "/_logs/" in rel or rel.startswith("_logs") or rel.startswith("merge_from_server2/_logs")
+
+def _merge_tmp_pid(name):
+    """pid trong tên file tạm `.<tên>.merge-<pid>-<tid>.tmp` (xem _tmp_path); None nếu không phải file tạm."""
+    if not (name.startswith(".") and name.endswith(".tmp")) or ".merge-" not in name:
+        return None
+    ids = name[:-4].rpartition(".merge-")[2].split("-")
+    if len(ids) != 2 or not all(x.isdigit() for x in ids):
+        return None
+    return int(ids[0])
+
+def _is_ignored_rel(rel):
+    """Path local không phải nội dung: log của merge và file tạm đang/đã dở của copy."""
+    return _is_logs_rel(rel) or _merge_tmp_pid(rel.rpartition("/")[2]) is not None
+
+def _scan_one_dir(root, rel_dir, prev_mtime_ns, known_subdirs, prune, cutoff_ns):
+    """
+    Liệt kê 1 thư mục bằng os.scandir (chạy trong thread).
+    Trả (rel_dir, mtime_ns, files|None, subdirs); files=None nghĩa là thư mục được
+    bỏ qua vì mtime không đổi từ vòng trước (subdirs lấy từ dirmeta_local).
+    """
+    full_dir = os.path.join(root, rel_dir) if rel_dir else root
+    try:
+        dir_mtime_ns = os.stat(full_dir).st_mtime_ns
+    except OSError:
+        return None
+
+    # mtime quá sát thời điểm quét thì không tin (có thể còn ghi trong cùng giây)
+    if (prune and prev_mtime_ns == dir_mtime_ns and dir_mtime_ns < cutoff_ns
+            and known_subdirs is not None):
+        return rel_dir, dir_mtime_ns, None, known_subdirs
+
+    files, subdirs = [], []
+    prefix = rel_dir + "/" if rel_dir else ""
+    try:
+        with os.scandir(full_dir) as it:
+            for entry in it:
+                rel = prefix + entry.name
+                try:
+                    if entry.is_dir():
+                        # giống os.walk: không đi vào symlink thư mục, bỏ mọi nhánh *_logs*
+                        if entry.name != "_logs" and not entry.is_symlink():
+                            subdirs.append(rel)
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if _is_ignored_rel(rel):
+                    continue
+                files.append((rel, st.st_size, int(st.st_mtime)))
+    except OSError:
+        return None
+    return rel_dir, dir_mtime_ns, files, subdirs
+
+def scan_local_dirs(root, dir_state=None, prune=False, threads=None, start=""):
+    """
+    Walk song song theo thư mục (từ `start`): yields (rel_dir, mtime_ns, files|None).
+    dir_state: {rel_dir: (parent, mtime_ns)} từ vòng trước, dùng để prune thư mục không đổi.
+    Chỉ giữ tối đa threads*2 thư mục in-flight; hàng đợi chỉ chứa tên thư mục.
+    """
     root = os.path.abspath(root)
-    items = []  # (rel, size, mtime)
-
-    for dirpath, dirnames, filenames in os.walk(root):
-        # IGNORE all *_logs* directories (eg: merge_from_server2/_logs, _logs)
-        rel_dir = os.path.relpath(dirpath, root).replace("\\", "/")
-        if rel_dir == "_logs" or rel_dir.endswith("/_logs") or "/_logs/" in rel_dir:
-            # Don't go any further into the _logs branch
-            dirnames[:] = []
-            continue
+    dir_state = dir_state or {}
+    threads = max(1, int(threads or LOCAL_SCAN_THREADS))
+    cutoff_ns = time.time_ns() - 2 * 10**9
+
+    children = defaultdict(list)
+    for rel_dir, (parent, _) in dir_state.items():
+        if rel_dir:
+            children[parent].append(rel_dir)
+
+    pending_dirs = deque([start])
+    inflight = set()
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="scan") as ex:
+        while pending_dirs or inflight:
+            while pending_dirs and len(inflight) < threads * 2:
+                rel_dir = pending_dirs.popleft()
+                prev = dir_state.get(rel_dir)
+                inflight.add(ex.submit(
+                    _scan_one_dir, root, rel_dir,
+                    prev[1] if prev else None,
+                    children.get(rel_dir, []) if prev else None,
+                    prune, cutoff_ns,
+                ))
+            done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                res = fut.result()
+                if res is None:
+                    continue
+                rel_dir, mtime_ns, files, subdirs = res
+                pending_dirs.extend(subdirs)
+                yield rel_dir, mtime_ns, files
 
-        for name in filenames:
-            full = os.path.join(dirpath, name)
-            try:
-                st = os.stat(full)
-            except Exception:
-                continue
-            rel = os.path.relpath(full, root).replace("\\", "/")
-            # If the file is in _logs then ignore it
-            if "/_logs/" in rel or rel.startswith("_logs") or rel.startswith("merge_from_server2/_logs"):
-                continue
-            items.append((rel, st.st_size, int(st.st_mtime)))
-    return items
+def scan_local_metadata(root):
+    """Yields (rel, size, mtime) cho toàn cây, bỏ qua *_logs*. Không build list toàn cây."""
+    for _, _, files in scan_local_dirs(root):
+        yield from files
+
+def _load_dir_state(cur, root):
+    cur.execute("SELECT rel, parent, mtime_ns FROM dirmeta_local WHERE root=?", (root,))
+    return {rel: (parent, mtime_ns) for rel, parent, mtime_ns in cur.fetchall()}
+
+def _carry_forward_pruned_dirs(cur, root, algo, pruned_dirs, now, prev_scan):
+    """Bump last_seen cho file nằm trực tiếp trong các thư mục được prune (đã thấy ở vòng trước)."""
+    if not pruned_dirs:
+        return
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS scan_pruned_dirs(rel TEXT PRIMARY KEY)")
+    cur.execute("DELETE FROM scan_pruned_dirs")
+    cur.executemany("INSERT OR IGNORE INTO scan_pruned_dirs(rel) VALUES(?)", [(d,) for d in pruned_dirs])
+    # '+algo': ép planner đi theo PK (dir_id, ...) thay vì quét idx theo algo
+    cur.execute(f"""UPDATE filemeta_local SET last_seen=?
+                    WHERE dir_id IN (SELECT id FROM path_dir
+                                     WHERE root_id={_LOCAL_ROOT_ID_SQL}
+                                       AND path IN (SELECT rel FROM scan_pruned_dirs))
+                      AND +algo=? AND last_seen>=? AND last_seen<?""",
+                (now, root, _algo_id(algo), prev_scan, now))
+    cur.execute("DELETE FROM scan_pruned_dirs")
+
+def _load_local_rows(cur, ids, root_id, algo, rels):
+    """Bulk-load các row đã có cho 1 chunk rel, gom theo thư mục -> {rel: (size, mtime, hash, phash)}."""
+    by_dir = defaultdict(list)
+    for rel in rels:
+        path, _, name = rel.rpartition("/")
+        by_dir[path].append(name)
+    found = {}
+    aid = _algo_id(algo)
+    for path, names in by_dir.items():
+        dir_id = ids.dir(root_id, path, create=False)
+        if dir_id is None:
+            continue
+        prefix = path + "/" if path else ""
+        for i in range(0, len(names), SQLITE_MAX_VARS):
+            part = names[i:i + SQLITE_MAX_VARS]
+            marks = ",".join("?" * len(part))
+            cur.execute(f"""SELECT name, size, mtime, hash, phash FROM filemeta_local
+                            WHERE dir_id=? AND algo=? AND name IN ({marks})""",
+                        (dir_id, aid, *part))
+            for name, size, mtime, h, ph in cur.fetchall():
+                found[prefix + name] = (size, mtime, h, ph)
+    return found
 
 def refresh_local_cache(root, algo):
-    """Update local metadata to DB, only hash dirty files (có progress)."""
-    db_init()
+    """Update local metadata to DB, only hash dirty files (có progress).
+    Scan dạng stream (scan_local_dirs): thư mục có mtime không đổi được prune và
+    chỉ bump last_seen; file của các thư mục còn lại gom theo chunk LOCAL_SCAN_BATCH,
+    bulk-load từ DB, file dirty hash song song qua LocalHashPool, ghi bằng bulk op của CacheDB
+    qua CacheWriter (group commit ở thread writer, thread scan không chờ commit).
+    Nếu LOCAL_WATCH_ENABLED: các vòng giữa 2 lần đối soát chỉ xử lý path trong journal inotify."""
     now = _now()
     hashed = 0
-    with sqlite3.connect(CACHE_DB) as db:
-        db.row_factory = sqlite3.Row
+    journal = _get_local_journal(root)
+    pool = LocalHashPool(algo)
+    aid = _algo_id(algo)
+    w = cache_writer()
+    w.flush()
+    with cache_db() as db:
         cur = db.cursor()
-        items = scan_local_metadata(root)
+        ids = PathIds(db, w)
+        root_id = ids.root("", root)
+
+        prev_scan = _state_get(cur, f"local_scan_ts:{root}")
+        last_full = _state_get(cur, f"local_full_scan_ts:{root}", 0)
+        same_algo = _state_get(cur, f"local_scan_algo:{root}") == algo
+        journal_mode = False
+        if journal is not None:
+            paths, new_dirs, gone_dirs, overflow = journal.drain()
+            journal_mode = (not overflow and prev_scan is not None and same_algo
+                            and now - last_full < LOCAL_WATCH_RECONCILE_EVERY)
+        full_scan = (not LOCAL_PRUNE_UNCHANGED_DIRS
+                     or prev_scan is None
+                     or not same_algo
+                     or now - last_full >= LOCAL_FULL_SCAN_EVERY
+                     or (journal is not None and not journal_mode))
+        dir_state = {} if (full_scan or journal_mode) else _load_dir_state(cur, root)
 
-        iterator = items
         pbar = None
         if USE_TQDM:
             try:
                 from tqdm import tqdm
-                pbar = tqdm(items, desc="🔍 Hashing local (dirty files)",
+                pbar = tqdm(desc="🔍 Hashing local (dirty files)",
                             unit="file", dynamic_ncols=True, leave=False)
-                iterator = pbar
             except Exception:
                 pbar = None
-                iterator = items
 
-        for rel, size, mtime in iterator:
-            cur.execute("""SELECT size, mtime, hash FROM filemeta_local
-                           WHERE root=? AND rel=? AND algo=?""",
-                        (root, rel, algo))
-            row = cur.fetchone()
-            is_dirty = (row is None) or (row["size"] != size) or (row["mtime"] != mtime) or (row["hash"] is None)
-
-            if is_dirty:
-                full = os.path.join(root, rel)
-                try:
-                    h = compute_hash_local(full, algo)
-                except Exception:
-                    h = None
-                cur.execute("""INSERT OR REPLACE INTO filemeta_local
-                               (root, rel, size, mtime, algo, hash, last_seen, last_hashed)
-                               VALUES(?,?,?,?,?,?,?,?)""",
-                            (root, rel, size, mtime, algo, h, now, now if h else None))
-                hashed += 1
-            else:
-                cur.execute("""UPDATE filemeta_local
-                               SET last_seen=? WHERE root=? AND rel=? AND algo=?""",
-                            (now, root, rel, algo))
+        def _write_hashed(results):
+            ids.prefetch(root_id, [rel for (rel, size, mtime, mode), h, ph in results])
+            rows = [(root_id, *ids.rel(root_id, rel), size, mtime, aid, _hash_blob(h), _hash_blob(ph),
+                     now, now if h else None)
+                    for (rel, size, mtime, mode), h, ph in results if mode == "full"]
+            if rows:
+                w.submit(CacheDB.upsert_local_files, rows, weight=len(rows))
+            # bù phash cho row cũ (chưa có tier partial) — không tính vào số file hashed
+            prows = [(_hash_blob(ph), *ids.rel(root_id, rel), aid)
+                     for (rel, size, mtime, mode), h, ph in results if mode == "partial" and ph]
+            if prows:
+                w.submit(CacheDB.set_local_phashes, prows, weight=len(prows))
+            return len(rows)
+
+        def _process(batch):
+            nonlocal hashed
+            existing = _load_local_rows(cur, ids, root_id, algo, [rel for rel, _, _ in batch])
+            finished, seen_rows = [], []
+
+            for rel, size, mtime in batch:
+                row = existing.get(rel)
+                is_dirty = (row is None) or (row[0] != size) or (row[1] != mtime) or (row[2] is None)
+
+                if is_dirty:
+                    finished.extend(pool.submit((rel, size, mtime, "full"), os.path.join(root, rel)))
+                else:
+                    seen_rows.append((*ids.rel(root_id, rel), aid))
+                    if row[3] is None and _needs_partial(size):
+                        finished.extend(pool.submit((rel, size, mtime, "partial"),
+                                                    os.path.join(root, rel), mode="partial"))
+
+            hashed += _write_hashed(finished)
+            if seen_rows:
+                w.submit(CacheDB.touch_local_files, now, seen_rows, weight=len(seen_rows))
             if pbar:
-                pbar.update(0)  # giữ nhịp vẽ (không tăng số lượng)
-        db.commit()
+                pbar.update(len(batch))
+
+        if journal_mode:
+            try:
+                for rel_dir in gone_dirs:
+                    w.submit(_delete_local_subtree, root, rel_dir)
+                if gone_dirs:
+                    # DELETE phải xong trước khi _load_local_rows đọc lại: thư mục xoá rồi tạo lại (hoặc 2
+                    # thư mục đổi tên cho nhau) trong 1 cửa sổ journal -> đọc row cũ, chỉ touch, rồi
+                    # DELETE xếp hàng trước xoá mất row -> planner copy lại file đã có ở local
+                    w.flush()
+                # chỉ quét thư mục mới ở mức cao nhất (thư mục con nằm trong subtree của nó)
+                new_tops = [d for d in new_dirs
+                            if not any(d.startswith(o + "/") for o in new_dirs)]
+                top_set = set(new_tops)
+
+                def _under_new_dir(rel):
+                    d = _parent_rel(rel)
+                    while d:
+                        if d in top_set:
+                            return True
+                        d = _parent_rel(d)
+                    return False
+
+                gone_rows, buf = [], []
+                for rel in paths:
+                    if _under_new_dir(rel):
+                        continue  # subtree mới được quét lại bên dưới, không xử lý 2 lần
+                    try:
+                        st = os.stat(os.path.join(root, rel))
+                    except OSError:
+                        dir_id, name = ids.rel(root_id, rel, create=False)
+                        if dir_id is not None:
+                            gone_rows.append((dir_id, name))
+                        continue
+                    if stat.S_ISREG(st.st_mode):
+                        buf.append((rel, st.st_size, int(st.st_mtime)))
+                    if len(buf) >= LOCAL_SCAN_BATCH:
+                        _process(buf)
+                        buf = []
+                if gone_rows:
+                    w.submit(CacheDB.delete_local_files, gone_rows, weight=len(gone_rows))
+                dir_rows = []
+                for start in new_tops:
+                    for rel_dir, mtime_ns, files in scan_local_dirs(root, start=start):
+                        dir_rows.append((root, rel_dir, _parent_rel(rel_dir), mtime_ns, now))
+                        buf.extend(files)
+                        if len(buf) >= LOCAL_SCAN_BATCH:
+                            _process(buf)
+                            buf = []
+                if buf:
+                    _process(buf)
+                hashed += _write_hashed(pool.drain())
+                w.submit(CacheDB.upsert_dir_mtimes, dir_rows, weight=len(dir_rows))
+                if paths or new_dirs or gone_dirs:
+                    print(f"[local-journal] {root}: {len(paths)} paths, {len(new_dirs)} new dirs, "
+                          f"{len(gone_dirs)} removed dirs")
+            finally:
+                pool.close()
+                if pbar:
+                    pbar.close()
+            return hashed
 
-        if pbar:
-            pbar.close()
+        try:
+            dir_rows, pruned_dirs, buf = [], [], []
+            for rel_dir, mtime_ns, files in scan_local_dirs(root, dir_state, prune=not full_scan):
+                dir_rows.append((root, rel_dir, _parent_rel(rel_dir), mtime_ns, now))
+                if files is None:
+                    pruned_dirs.append(rel_dir)
+                    continue
+                buf.extend(files)
+                if len(buf) >= LOCAL_SCAN_BATCH:
+                    _process(buf)
+                    buf = []
+            if buf:
+                _process(buf)
+
+            hashed += _write_hashed(pool.drain())
+            if not full_scan:
+                w.submit(_carry_forward_pruned_dirs, root, algo, pruned_dirs, now, prev_scan)
+
+            # dirmeta chỉ ghi sau mọi file (writer chạy FIFO) -> crash giữa chừng thì vòng sau liệt kê lại
+            w.submit(CacheDB.upsert_dir_mtimes, dir_rows, weight=len(dir_rows))
+            w.submit(_state_set, f"local_scan_ts:{root}", now)
+            w.submit(_state_set, f"local_scan_algo:{root}", algo)
+            w.submit(_state_set, f"local_valid_since:{root}", now)
+            if full_scan:
+                w.submit(_state_set, f"local_full_scan_ts:{root}", now)
+            if pruned_dirs:
+                print(f"[local-scan] {root}: {len(dir_rows)} dirs, {len(pruned_dirs)} unchanged (skipped listing)")
+        finally:
+            pool.close()
+            if pbar:
+                pbar.close()
     return hashed
 
+# ===================== Local change journal (inotify) =====================
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+_IN_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                  | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW)
+_IN_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+class LocalChangeJournal:
+    """
+    Theo dõi SERVER1_ROOT bằng inotify (ctypes, không cần thư viện ngoài).
+    Thread nền gom path thay đổi vào journal; refresh_local_cache() lấy ra bằng drain().
+    overflow=True (IN_Q_OVERFLOW, hết watch, journal quá lớn) -> vòng sau phải full scan.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._lock = threading.Lock()
+        self._wd_to_rel = {}
+        self._paths, self._dirs, self._gone_dirs = set(), set(), set()
+        # vòng đầu luôn full scan: thay đổi lúc daemon chưa chạy không có trong journal
+        self.overflow = True
+        self._add_watch_tree("")
+        self._thread = threading.Thread(target=self._run, name="inotify", daemon=True)
+        self._thread.start()
+
+    def _add_watch(self, rel_dir):
+        full = os.path.join(self.root, rel_dir) if rel_dir else self.root
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(full), _IN_WATCH_MASK)
+        if wd < 0:
+            # ENOSPC (max_user_watches) ... -> không còn tin journal được
+            with self._lock:
+                self.overflow = True
+            return False
+        self._wd_to_rel[wd] = rel_dir
+        return True
+
+    def _add_watch_tree(self, rel_dir):
+        stack = [rel_dir]
+        while stack:
+            cur_rel = stack.pop()
+            if not self._add_watch(cur_rel):
+                continue
+            full = os.path.join(self.root, cur_rel) if cur_rel else self.root
+            try:
+                with os.scandir(full) as it:
+                    for entry in it:
+                        if entry.name != "_logs" and entry.is_dir(follow_symlinks=False):
+                            stack.append(f"{cur_rel}/{entry.name}" if cur_rel else entry.name)
+            except OSError:
+                continue
+
+    def _drop_watch_tree(self, rel_dir):
+        prefix = rel_dir + "/"
+        for wd, rel in list(self._wd_to_rel.items()):
+            if rel == rel_dir or rel.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                self._wd_to_rel.pop(wd, None)
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            with self._lock:
+                self.overflow = True
+            return
+        if mask & IN_IGNORED:
+            self._wd_to_rel.pop(wd, None)
+            return
+        rel_dir = self._wd_to_rel.get(wd)
+        if rel_dir is None or not name:
+            return
+        rel = f"{rel_dir}/{name}" if rel_dir else name
+
+        if mask & IN_ISDIR:
+            if name == "_logs":
+                return
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self._drop_watch_tree(rel)
+                with self._lock:
+                    self._gone_dirs.add(rel)
+                    self._dirs.discard(rel)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_watch_tree(rel)
+                with self._lock:
+                    self._dirs.add(rel)
+            return
+
+        if _is_ignored_rel(rel):
+            return
+        with self._lock:
+            self._paths.add(rel)
+            if len(self._paths) > LOCAL_WATCH_MAX_PATHS:
+                self.overflow = True
+                self._paths.clear()
+
+    def _run(self):
+        while True:
+            try:
+                buf = os.read(self._fd, 256 * 1024)
+            except InterruptedError:
+                continue
+            except OSError:
+                with self._lock:
+                    self.overflow = True
+                return
+            off = 0
+            while off + _IN_EVENT.size <= len(buf):
+                wd, mask, _cookie, nlen = _IN_EVENT.unpack_from(buf, off)
+                off += _IN_EVENT.size
+                name = os.fsdecode(buf[off:off + nlen].rstrip(b"\0"))
+                off += nlen
+                self._handle(wd, mask, name)
+
+    def drain(self):
+        """Lấy & reset journal: (paths, dirs_to_scan, gone_dirs, overflow)."""
+        with self._lock:
+            out = (self._paths, self._dirs, self._gone_dirs, self.overflow)
+            self._paths, self._dirs, self._gone_dirs = set(), set(), set()
+            self.overflow = False
+        return out
+
+_local_journals = {}
+
+def _get_local_journal(root):
+    """Journal theo root (khởi tạo lần đầu); None nếu tắt hoặc không hỗ trợ inotify."""
+    if not LOCAL_WATCH_ENABLED:
+        return None
+    if root not in _local_journals:
+        try:
+            _local_journals[root] = LocalChangeJournal(root)
+            print(f"👀 inotify journal enabled for {root}")
+        except Exception as e:
+            print(f"⚠️ inotify unavailable ({e}) — fallback to full scan")
+            _local_journals[root] = None
+    return _local_journals[root]
+
+def local_cache_valid_since(root, default=None):
+    """
+    Mốc last_seen tối thiểu để coi row filemeta_local là còn hiện hành.
+    Vòng scan thường bump last_seen mọi file còn tồn tại -> mốc = thời điểm scan;
+    vòng journal chỉ chạm path thay đổi (path bị xóa thì xóa row) -> mốc giữ nguyên từ lần scan gần nhất.
+    """
+    cache_writer().flush()
+    return _state_get(cache_db(), f"local_valid_since:{root}", default)
+
+def _delete_local_subtree(cur, root, rel_dir):
+    lo, hi = rel_dir + "/", rel_dir + "0"  # '0' là ký tự ngay sau '/'
+    cur.execute(f"""DELETE FROM filemeta_local WHERE dir_id IN (
+                        SELECT id FROM path_dir WHERE root_id={_LOCAL_ROOT_ID_SQL}
+                          AND (path=? OR (path>=? AND path<?)))""", (root, rel_dir, lo, hi))
+    cur.execute("DELETE FROM dirmeta_local WHERE root=? AND (rel=? OR (rel>=? AND rel<?))",
+                (root, rel_dir, lo, hi))
+
 # ===================== Remote scan =====================
 def _ssh_exec(ssh_client, cmd):
     stdin, stdout, stderr = ssh_client.exec_command(cmd, get_pty=False)
@@ -290,6 +1520,65 @@ def _ssh_exec(ssh_client, cmd):
     err = stderr.read().decode("utf-8", "ignore")
     return out, err
 
+def _iter_channel_chunks(chan, err_chunks, bufsize=256 * 1024):
+    """
+    Đọc stdout của channel theo từng block (bytes).
+    stderr được rút song song vào err_chunks để remote không bị nghẽn window.
+    """
+    chan.settimeout(1.0)
+    while True:
+        while chan.recv_stderr_ready():
+            err_chunks.append(chan.recv_stderr(bufsize))
+        try:
+            data = chan.recv(bufsize)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        yield data
+    while chan.recv_stderr_ready():
+        err_chunks.append(chan.recv_stderr(bufsize))
+
+def _iter_channel_lines(chan, err_chunks, sep=b"\n", bufsize=256 * 1024):
+    """Như _iter_channel_chunks nhưng yield từng dòng (bytes, không gồm sep)."""
+    pending = b""
+    for data in _iter_channel_chunks(chan, err_chunks, bufsize):
+        pending += data
+        lines = pending.split(sep)
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+class _TarStreamError(Exception):
+    """Luồng tar (exec_command) lỗi giữa 1 member: member đó chưa có kết quả, copy lại từng file."""
+
+class _ChunkReader:
+    """File-like read() trên 1 iterator các block bytes (vd stdout channel -> tarfile mode 'r|')."""
+
+    def __init__(self, chunks):
+        self._it = iter(chunks)
+        self._buf = b""
+        self._pos = 0
+
+    def read(self, n=-1):
+        while n < 0 or len(self._buf) - self._pos < n:
+            data = next(self._it, None)
+            if data is None:
+                break
+            self._buf = self._buf[self._pos:] + data
+            self._pos = 0
+        end = len(self._buf) if n < 0 else self._pos + n
+        out = self._buf[self._pos:end]
+        self._pos = end
+        return out
+
+def _ssh_exec_lines(ssh_client, cmd, err_chunks):
+    """Như _ssh_exec nhưng stream stdout theo dòng (str) thay vì đọc toàn bộ vào RAM."""
+    stdin, stdout, stderr = ssh_client.exec_command(cmd, get_pty=False)
+    for line in _iter_channel_lines(stdout.channel, err_chunks):
+        yield line.decode("utf-8", "ignore")
+
 def detect_remote_hash_algo(ssh_client):
     try:
         out, _ = _ssh_exec(ssh_client, "command -v b3sum >/dev/null 2>&1 && echo OK || echo NO")
@@ -299,110 +1588,387 @@ def detect_remote_hash_algo(ssh_client):
         pass
     return "sha256"
 
-def list_remote_metadata(ssh_client, root):
-    """Returns a list of (rel, mtime_epoch, size), ignoring the *_logs* directory on the remote."""
+def list_remote_metadata(ssh_client, root, since=None, info=None, start=None):
+    """
+    Yields (rel, mtime_epoch, size) khi find còn đang chạy, ignoring the *_logs* directory on the remote.
+    since: epoch (đồng hồ remote) -> chỉ liệt kê file có ctime mới hơn (tạo/sửa/chmod/rename chính file đó).
+    Rename 1 thư mục không đổi ctime của file bên trong: với since, thư mục có ctime mới hơn được ghi vào
+    info["changed_dirs"] [(rel_dir, mtime_epoch)] để bên gọi liệt kê lại subtree của nó.
+    info: dict nhận "remote_ts" = `date +%s` phía remote lúc bắt đầu find và "complete" = True chỉ khi
+    find chạy hết và exit 0 (dòng trailer `__END__ <rc>` sau find; luồng bị cắt thì không có trailer).
+    start: chỉ liệt kê subtree này (rel so với root; rel trả về vẫn tính từ root).
+    """
     root_esc = root.replace("'", "'\\''")
+    top = "./" + start.replace("'", "'\\''") if start else "."
+    files = "-type f -printf '%T@\\t%s\\t%p\\n'"
+    if since:
+        newer = f"-newerct '@{int(since)}'"
+        files = (f"\\( -type f {newer} -printf '%T@\\t%s\\t%p\\n' \\) -o "
+                 f"\\( -type d ! -name _logs ! -path . {newer} -printf 'D\\t%T@\\t%p\\n' \\)")
     # Drop files in any directory named _logs
     cmd = (
-        f"cd '{root_esc}' && "
-        f"find . -type f "
+        f"cd '{root_esc}' && date +%s && {{ "
+        f"find '{top}' "
         f"! -path './_logs/*' ! -path '*/_logs/*' "
-        f"-printf '%T@\\t%s\\t%p\\n'"
+        f"{files}; echo \"__END__ $?\"; }}"
     )
-    out, err = _ssh_exec(ssh_client, cmd)
-    if err.strip():
-        print(f"[remote-meta:{root}] {err.strip()}")
-    items = []
-    for line in out.splitlines():
+    err_chunks = []
+    first = True
+    for line in _ssh_exec_lines(ssh_client, cmd, err_chunks):
+        if first:
+            first = False
+            if line.strip().isdigit():
+                if info is not None:
+                    info["remote_ts"] = int(line.strip())
+                continue
         line = line.strip()
         if not line:
             continue
+        if line.startswith("__END__ "):
+            if info is not None:
+                info["complete"] = line.split()[1] == "0"
+            continue
+        if line.startswith("D\t"):
+            _, mtime_s, relp = line.split("\t", 2)
+            if info is not None:
+                relp = relp[2:] if relp.startswith("./") else relp
+                info.setdefault("changed_dirs", []).append((relp, int(float(mtime_s))))
+            continue
         try:
             mtime_s, size_s, relp = line.split("\t", 2)
             if relp.startswith("./"):
                 relp = relp[2:]
             mtime_epoch = int(float(mtime_s))  # %T@ is float -> cast to int
-            items.append((relp.replace("\\","/"), mtime_epoch, int(size_s)))
+            yield (relp.replace("\\","/"), mtime_epoch, int(size_s))
         except Exception:
             continue
-    return items
+    err = b"".join(err_chunks).decode("utf-8", "ignore")
+    if err.strip():
+        print(f"[remote-meta:{root}] {err.strip()}")
+
+def _carry_forward_remote(db, root_id, aid, now, prev_ts):
+    """Listing incremental: row đã thấy ở vòng trước coi như vẫn còn (bump last_seen)."""
+    db.execute("UPDATE filemeta_remote SET last_seen=? WHERE root_id=? AND algo=? AND last_seen>=?",
+               (now, root_id, aid, prev_ts))
 
 def refresh_remote_metadata(ssh_client, host, roots, algo):
-    """Chỉ update metadata (size/mtime/last_seen); KHÔNG hash ở đây"""
-    db_init()
+    """Chỉ update metadata (size/mtime/last_seen); KHÔNG hash ở đây.
+    Output find được parse dạng stream và upsert theo batch REMOTE_META_BATCH (commit mỗi batch).
+    Chế độ incremental: carry forward last_seen các row đã thấy ở vòng trước rồi chỉ upsert delta."""
     now = _now()
-    with sqlite3.connect(CACHE_DB) as db:
+    w = cache_writer()
+    w.flush()
+    with cache_db() as db:
         cur = db.cursor()
+        ids = PathIds(db, w)
         for root in roots:
-            items = list_remote_metadata(ssh_client, root)
-            print(f"[remote-meta] {root}: {len(items)} files")
-
-            for rel, mtime, size in items:
-                cur.execute("""
-                INSERT INTO filemeta_remote(host, root, rel, size, mtime, algo, hash, last_seen, last_hashed)
-                VALUES(?,?,?,?,?,?,NULL,?,NULL)
-                ON CONFLICT(host, root, rel, algo) DO UPDATE SET
-                size=excluded.size,
-                mtime=excluded.mtime,
-                last_seen=excluded.last_seen,
-                -- nếu metadata đổi => làm rỗng hash và last_hashed để buộc re-hash
-                hash = CASE
-                    WHEN filemeta_remote.size != excluded.size OR filemeta_remote.mtime != excluded.mtime
-                    THEN NULL
-                    ELSE filemeta_remote.hash
-                END,
-                last_hashed = CASE
-                    WHEN filemeta_remote.size != excluded.size OR filemeta_remote.mtime != excluded.mtime
-                    THEN NULL
-                    ELSE filemeta_remote.last_hashed
-                END
-                """, (host, root, rel, size, mtime, algo, now))
-        db.commit()
-
-def _choose_remote_to_hash_budget(host, roots, algo, limit_files, limit_bytes):
-    db_init()
-    with sqlite3.connect(CACHE_DB) as db:
-        db.row_factory = sqlite3.Row
-        cur = db.cursor()
-        q = """
-        SELECT host, root, rel, size, mtime, last_hashed
+            key = f"{host}:{root}"
+            root_id = ids.root(host, root)
+            prev_ts = _state_get(cur, f"remote_list_ts:{key}")
+            prev_rts = _state_get(cur, f"remote_list_rts:{key}")
+            last_full = _state_get(cur, f"remote_full_list_ts:{key}", 0)
+            incremental = (REMOTE_INCREMENTAL_LIST
+                           and prev_ts is not None and prev_rts is not None
+                           and _state_get(cur, f"remote_list_algo:{key}") == algo
+                           and now - last_full < REMOTE_FULL_LIST_EVERY)
+            since = None
+            if incremental:
+                since = max(0, prev_rts - REMOTE_INCREMENTAL_OVERLAP)
+                w.submit(_carry_forward_remote, root_id, _algo_id(algo), now, prev_ts)
+
+            info = {}
+            total = 0
+            relist, checked = [], 0
+
+            def _check_changed_dirs():
+                # thư mục ctime mới mà mtime cũ (rename/chmod, nội dung không đổi) hoặc chưa có trong
+                # path_dir (mới/vừa rename tới): file bên trong giữ ctime cũ -> phải liệt kê lại cả subtree.
+                # Kiểm tra trước prefetch của batch chứa file của nó (find in thư mục trước nội dung).
+                nonlocal checked
+                dirs = info.get("changed_dirs", [])
+                for rel_dir, dir_mtime in dirs[checked:]:
+                    if dir_mtime < since or ids.dir(root_id, rel_dir, create=False) is None:
+                        relist.append(rel_dir)
+                checked = len(dirs)
+
+            def _upsert(batch):
+                ids.prefetch(root_id, [rel for rel, _, _ in batch])
+                w.submit(CacheDB.upsert_remote_meta,
+                         [(root_id, *ids.rel(root_id, rel), size, mtime, _algo_id(algo), now)
+                          for rel, mtime, size in batch], weight=len(batch))
+                return len(batch)
+
+            for batch in _iter_batches(list_remote_metadata(ssh_client, root, since=since, info=info),
+                                       REMOTE_META_BATCH):
+                _check_changed_dirs()
+                total += _upsert(batch)
+            if incremental and info.get("complete"):
+                _check_changed_dirs()
+                # chỉ subtree ở mức cao nhất; path cũ (trước rename) còn row tới lần full listing kế tiếp
+                tops = set(relist)
+                tops = [d for d in relist if not any(p in tops for p in _ancestors(d))]
+                for rel_dir in tops:
+                    sub_info = {}
+                    for batch in _iter_batches(list_remote_metadata(ssh_client, root, info=sub_info,
+                                                                    start=rel_dir), REMOTE_META_BATCH):
+                        total += _upsert(batch)
+                    if not sub_info.get("complete"):
+                        info["complete"] = False  # liệt kê lại lỗi -> không lưu mốc, vòng sau lấy lại
+                if tops:
+                    print(f"[remote-meta] {root}: re-listed {len(tops)} renamed/changed dirs")
+
+            # chỉ lưu mốc khi listing chạy trọn (trailer __END__ 0) -> lỗi giữa chừng thì vòng sau lấy lại
+            # từ mốc cũ (full listing bị cắt: remote_full_list_ts không đổi -> vòng sau full lại)
+            if not info.get("complete"):
+                print(f"⚠️ [remote-meta] {root}: listing incomplete — cutoff not saved, retry next cycle")
+            elif "remote_ts" in info:
+                w.submit(_state_set, f"remote_list_ts:{key}", now)
+                w.submit(_state_set, f"remote_list_rts:{key}", info["remote_ts"])
+                w.submit(_state_set, f"remote_list_algo:{key}", algo)
+                if not incremental:
+                    w.submit(_state_set, f"remote_full_list_ts:{key}", now)
+            mode = "changed" if incremental else "files"
+            print(f"[remote-meta] {root}: {total} {mode}")
+
+# Thứ tự ưu tiên hash remote: stale trước (0), rồi REMOTE_HASH_SECONDARY giảm dần.
+# Biểu thức phải giống hệt trong index idx_remote_hash_todo_* để SQLite đọc theo index và dừng ở LIMIT.
+_REMOTE_STALE_RANK_SQL = "(last_hashed IS NOT NULL AND last_hashed >= mtime)"
+_REMOTE_NEEDS_HASH_SQL = "(hash IS NULL OR last_hashed IS NULL OR last_hashed < mtime)"
+
+def _choose_remote_to_hash_budget(host, roots, algo, limit_files, limit_bytes, local_root=None):
+    """Chọn file remote cần hash trong budget. Có local_root + REMOTE_SIZE_PREFILTER:
+    bỏ qua file có size không trùng file local nào (đã unique theo size, xem compute_planned).
+    Sắp xếp, LIMIT số file và cắt theo tổng bytes (SUM() OVER) đều làm trong SQLite:
+    chỉ trả về đúng tập được chọn, không kéo cả backlog lên Python."""
+    secondary = "mtime" if REMOTE_HASH_SECONDARY == "mtime" else "size"
+    order = f"{_REMOTE_STALE_RANK_SQL}, {secondary} DESC"
+    where = f"root_id IN {_HOST_ROOT_IDS_SQL} AND algo=? AND {_REMOTE_NEEDS_HASH_SQL}"
+    aid = _algo_id(algo)
+    params = [host, aid]
+    if local_root and REMOTE_SIZE_PREFILTER:
+        where += f""" AND EXISTS (SELECT 1 FROM filemeta_local l
+                             WHERE l.root_id={_LOCAL_ROOT_ID_SQL} AND l.algo=? AND l.size=filemeta_remote.size)"""
+        params += [local_root, aid]
+    if local_root and PARTIAL_HASH_ENABLED:
+        # file lớn: chỉ full hash khi đã có phash và phash trùng 1 file local cùng size
+        where += f""" AND (filemeta_remote.size < ? OR (filemeta_remote.phash IS NOT NULL AND EXISTS (
+                    SELECT 1 FROM filemeta_local l
+                    WHERE l.root_id={_LOCAL_ROOT_ID_SQL} AND l.algo=? AND l.size=filemeta_remote.size
+                      AND (l.phash IS NULL OR l.phash=filemeta_remote.phash))))"""
+        params += [PARTIAL_HASH_MIN_SIZE, local_root, aid]
+    q = f"""
+    WITH cand AS (
+        SELECT root_id, dir_id, name, size, {_REMOTE_STALE_RANK_SQL} AS stale_rank, {secondary} AS secondary
         FROM filemeta_remote
-        WHERE host=? AND algo=? AND (
-            hash IS NULL OR last_hashed IS NULL OR last_hashed < mtime
-        )
-        """
-        cur.execute(q, (host, algo))
-        rows = cur.fetchall()
+        WHERE {where}
+        ORDER BY {order}
+        LIMIT ?
+    )
+    SELECT pr.root, {_rel_sql("c")}, c.size FROM (
+        SELECT root_id, dir_id, name, size, stale_rank, secondary,
+               SUM(COALESCE(size, 0)) OVER (ORDER BY stale_rank, secondary DESC
+                                            ROWS UNBOUNDED PRECEDING) AS running_bytes
+        FROM cand
+    ) c
+    JOIN path_dir d ON d.id=c.dir_id
+    JOIN path_root pr ON pr.id=c.root_id
+    WHERE ? <= 0 OR c.running_bytes <= ?
+    ORDER BY c.stale_rank, c.secondary DESC
+    """
+    # size >= 0 nên running_bytes tăng dần: "running_bytes <= limit" chính là prefix vừa budget
+    params += [limit_files if limit_files else -1, limit_bytes or 0, limit_bytes or 0]
+    cache_writer().flush()
+    return [tuple(r) for r in cache_db().execute(q, params)]
 
-    # Prioritize stale first, then depend on 'mtime' or 'size'
-    def sort_key(r):
-        stale_rank = 0 if (r["last_hashed"] is None or (r["last_hashed"] < r["mtime"])) else 1
-        secondary = r["mtime"] if REMOTE_HASH_SECONDARY == "mtime" else r["size"]
-        # stale_rank ASC, secondary DESC
-        return (stale_rank, -int(secondary))
+def _parse_hashsum_line(line):
+    """
+    Parse 1 dòng output sha256sum/b3sum -> (hash, rel) hoặc None.
+    Hỗ trợ dạng "<hash>  <path>", "<hash> *<path>" và dạng escape (dòng bắt đầu bằng '\\').
+    """
+    escaped = line.startswith("\\")
+    if escaped:
+        line = line[1:]
+    h, sep, rest = line.partition(" ")
+    if not sep or not h:
+        return None
+    relp = rest[1:] if rest[:1] in (" ", "*") else rest
+    if escaped:
+        relp = relp.replace("\\\\", "\0").replace("\\n", "\n").replace("\0", "\\")
+    if relp.startswith("./"):
+        relp = relp[2:]
+    return h, relp.replace("\\", "/")
+
+def _feed_stdin(stdin, rels, errors):
+    """Ghi danh sách file NUL-separated vào stdin của lệnh remote (chạy trong thread riêng)."""
+    try:
+        for rel in rels:
+            # prefix ./ để tên file bắt đầu bằng '-' không bị hiểu là option
+            stdin.write(b"./" + rel.encode("utf-8") + b"\0")
+        stdin.flush()
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stdin.channel.shutdown_write()
+        except Exception:
+            pass
 
-    rows = sorted(rows, key=sort_key)
+def _probe_remote_capacity(ssh_client):
+    """(nproc, load1) của server2; None nếu không đọc được."""
+    try:
+        out, _ = _ssh_exec(ssh_client, "nproc 2>/dev/null; cat /proc/loadavg 2>/dev/null")
+        lines = out.split("\n")
+        return max(1, int(lines[0].strip())), float(lines[1].split()[0])
+    except Exception:
+        return None
 
-    selected, total_bytes = [], 0
-    for r in rows:
-        if limit_files and len(selected) >= limit_files:
-            break
-        if limit_bytes and (total_bytes + (r["size"] or 0)) > limit_bytes:
-            break
-        selected.append((r["root"], r["rel"], r["size"]))
-        total_bytes += (r["size"] or 0)
-    return selected
+class RemoteHashTuner:
+    """
+    Điều chỉnh số tiến trình hash remote giữa các sub-batch (hill climbing theo bytes/s):
+    - trần = nproc - load ngoài (load1 trừ phần do chính mình tạo ra);
+    - load ngoài / nproc > REMOTE_HASH_LOAD_HIGH -> giảm một nửa (server2 đang bận phục vụ production);
+    - còn lại: throughput tăng thì đi tiếp theo hướng cũ, giảm thì đổi hướng.
+    Giữ trạng thái theo host giữa các vòng.
+    """
+
+    def __init__(self):
+        self.parallel = max(REMOTE_HASH_PARALLEL_MIN, min(REMOTE_HASH_PARALLEL_MAX, REMOTE_HASH_PARALLEL_START))
+        self.step = 1
+        self.last_rate = None
+        self.running = 0  # số tiến trình của mình trong cửa sổ load1 gần nhất
+
+    def next_parallel(self, ssh_client):
+        cap = REMOTE_HASH_PARALLEL_MAX
+        probe = _probe_remote_capacity(ssh_client)
+        if probe:
+            ncpu, load1 = probe
+            external = max(0.0, load1 - self.running)
+            cap = max(REMOTE_HASH_PARALLEL_MIN, min(REMOTE_HASH_PARALLEL_MAX, int(ncpu - external)))
+            if external / ncpu > REMOTE_HASH_LOAD_HIGH:
+                self.parallel = max(REMOTE_HASH_PARALLEL_MIN, self.parallel // 2)
+                self.step = 1
+                self.last_rate = None
+        self.parallel = max(REMOTE_HASH_PARALLEL_MIN, min(cap, self.parallel))
+        return self.parallel, probe
+
+    def observe(self, nbytes, seconds):
+        rate = nbytes / seconds if seconds > 0 else 0.0
+        if self.last_rate is not None and rate < self.last_rate * 0.95:
+            self.step = -self.step
+        self.last_rate = rate
+        self.running = self.parallel
+        self.parallel = max(REMOTE_HASH_PARALLEL_MIN, min(REMOTE_HASH_PARALLEL_MAX, self.parallel + self.step))
+        return rate
+
+_remote_hash_tuners = {}
+
+def _remote_partial_script(algo_bin):
+    """Script sh tính partial hash cho từng file "$@" — khớp byte-by-byte với compute_hashes_local()."""
+    n = PARTIAL_HASH_SEGMENT
+    return (
+        'for f; do '
+        's=$(stat -c %s -- "$f" 2>/dev/null) || continue; '
+        f'o=$(( (s - {n}) / 2 )); '
+        f'h=$({{ printf "%s\\n" "$s"; head -c {n} -- "$f"; '
+        f'tail -c +$((o + 1)) -- "$f" | head -c {n}; tail -c {n} -- "$f"; }} '
+        f'| {algo_bin} | cut -d" " -f1); '
+        'printf "%s  %s\\n" "$h" "$f"; '
+        'done'
+    )
+
+def _hash_remote_stream(ssh_client, host, algo, root, rels, parallel, db, pbar=None, partial=False):
+    """Hash 1 nhóm file cùng root qua stdin, đẩy kết quả sang CacheWriter mỗi REMOTE_HASH_COMMIT_BATCH dòng.
+    Trả số file đã hash.
+    partial=True: chỉ tính phash (đầu/giữa/cuối) thay vì đọc toàn bộ file."""
+    algo_bin = "b3sum" if algo == "blake3" else "sha256sum"
+    aid = _algo_id(algo)
+    now = _now()
+    w = cache_writer()
+    ids = PathIds(db, w)
+    root_id = ids.root(host, root, create=False)
+    root_esc = root.replace("'", "'\\''")
+    # chia nhỏ mỗi lần gọi để -P thực sự chạy song song (xargs mặc định dồn hết vào 1 tiến trình)
+    per_call = max(1, min(64, len(rels) // (parallel * 4) or 1))
+    if partial:
+        runner = f"sh -c {shlex.quote(_remote_partial_script(algo_bin))} _"
+    else:
+        runner = algo_bin
+    cmd = f"cd '{root_esc}' && xargs -0 -n {per_call} -P {parallel} {runner} 2>/dev/null"
+    stdin, stdout, stderr = ssh_client.exec_command(cmd, get_pty=False)
+    feed_errors, err_chunks, rows = [], [], []
+    feeder = threading.Thread(target=_feed_stdin, args=(stdin, rels, feed_errors),
+                              name="remote-hash-feed", daemon=True)
+    feeder.start()
+    hashed = 0
+
+    def _flush():
+        if rows and partial:
+            w.submit(CacheDB.set_remote_phashes, [(h, dir_id, name, a) for h, _, dir_id, name, a in rows],
+                     weight=len(rows))
+        elif rows:
+            w.submit(CacheDB.set_remote_hashes, list(rows), weight=len(rows))
+        rows.clear()
+
+    try:
+        # parse "<hash> <path>"
+        for raw in _iter_channel_lines(stdout.channel, err_chunks):
+            parsed = _parse_hashsum_line(raw.decode("utf-8", "ignore").rstrip("\r"))
+            if not parsed:
+                continue
+            h, relp = parsed
+            h = _hash_blob(h)
+            dir_id, name = ids.rel(root_id, relp, create=False)
+            if h is None or dir_id is None:
+                continue
+            rows.append((h, now, dir_id, name, aid))
+            hashed += 1
+            if pbar:
+                pbar.update(1)
+            if len(rows) >= REMOTE_HASH_COMMIT_BATCH:
+                _flush()
+    finally:
+        _flush()
+    feeder.join(timeout=10)
+
+    err = b"".join(err_chunks).decode("utf-8", "ignore")
+    if err.strip():
+        print(f"[remote-hash:{root}] {err.strip()}")
+    if feed_errors:
+        print(f"[remote-hash:{root}] stdin error: {feed_errors[0]}")
+    return hashed
 
-def hash_remote_batch(ssh_client, host, algo, entries):
+def _choose_remote_to_partial_hash(host, algo, local_root, limit_files):
+    """File remote lớn chưa có phash, chưa hash, trùng size với file local -> cần partial hash trước."""
+    if not PARTIAL_HASH_ENABLED:
+        return []
+    cache_writer().flush()
+    with cache_db() as db:
+        cur = db.execute(f"""
+        SELECT pr.root, {_rel_sql("r")}, r.size FROM filemeta_remote r
+        JOIN path_dir d ON d.id=r.dir_id
+        JOIN path_root pr ON pr.id=r.root_id
+        WHERE r.root_id IN {_HOST_ROOT_IDS_SQL} AND r.algo=? AND r.phash IS NULL AND r.size>=?
+          AND (r.hash IS NULL OR r.last_hashed IS NULL OR r.last_hashed < r.mtime)
+          AND EXISTS (SELECT 1 FROM filemeta_local l
+                      WHERE l.root_id={_LOCAL_ROOT_ID_SQL} AND l.algo=? AND l.size=r.size)
+        ORDER BY r.size DESC
+        LIMIT ?""", (host, _algo_id(algo), PARTIAL_HASH_MIN_SIZE, local_root, _algo_id(algo),
+                     int(limit_files or -1)))
+        return [tuple(r) for r in cur.fetchall()]
+
+def hash_remote_batch(ssh_client, host, algo, entries, partial=False):
     """
     entries: list of (root, rel, size)
     Run b3sum/sha256sum in batch to fill hash into DB. (có progress)
+    partial=True: chỉ điền phash (tier rẻ: size + 3 đoạn PARTIAL_HASH_SEGMENT).
+    Danh sách file gửi qua stdin (không giới hạn ARG_MAX), kết quả parse khi đang về
+    và commit mỗi REMOTE_HASH_COMMIT_BATCH dòng -> rớt kết nối giữa chừng vẫn giữ phần đã hash.
+    Chia sub-batch REMOTE_HASH_SUBBATCH_FILES file; độ song song chỉnh giữa các sub-batch (RemoteHashTuner).
     """
     if not entries:
         return 0
-    algo_bin = "b3sum" if algo == "blake3" else "sha256sum"
     hashed = 0
-    now = _now()
+    tuner = _remote_hash_tuners.setdefault(host, RemoteHashTuner())
 
     # Chuẩn bị progress cho tổng số file dự kiến hash
     pbar = None
@@ -410,130 +1976,253 @@ def hash_remote_batch(ssh_client, host, algo, entries):
     if USE_TQDM:
         try:
             from tqdm import tqdm
-            pbar = tqdm(total=total_planned, desc="🌐 Hashing remote (planned)",
+            pbar = tqdm(total=total_planned,
+                        desc="🌐 Partial hashing remote" if partial else "🌐 Hashing remote (planned)",
                         unit="file", dynamic_ncols=True, leave=False)
         except Exception:
             pbar = None
 
-    with sqlite3.connect(CACHE_DB) as db:
-        cur = db.cursor()
-
+    with cache_db() as db:
         # group by root để cd từng root
         by_root = defaultdict(list)
         for root, rel, size in entries:
-            by_root[root].append((rel, size))
-
-        for root, rels in by_root.items():
-            root_esc = root.replace("'", "'\\''")
-            # build file list qua printf (NUL-separated)
-            rels_esc = "".join(["printf '%s\\0' " + shlex.quote(r) + " ; " for r, _ in rels])
-            cmd = (
-                f"cd '{root_esc}' ; "
-                f"({rels_esc}) | xargs -0 -P 4 {algo_bin} 2>/dev/null"
-            )
-            out, err = _ssh_exec(ssh_client, cmd)
-            if err.strip():
-                print(f"[remote-hash:{root}] {err.strip()}")
-
-            # parse "<hash> <path>"
-            for line in out.splitlines():
-                line = line.strip()
-                if not line:
-                    continue
-                parts = line.split()
-                h = parts[0]
-                relp = " ".join(parts[1:]).lstrip("*").strip()
-                if relp.startswith("./"):
-                    relp = relp[2:]
-                relp = relp.replace("\\", "/")
-
-                cur.execute("""UPDATE filemeta_remote
-                               SET hash=?, last_hashed=?
-                               WHERE host=? AND root=? AND rel=? AND algo=?""",
-                            (h, now, host, root, relp, algo))
-                hashed += 1
-                if pbar:
-                    pbar.update(1)
-        db.commit()
+            by_root[root].append((rel, size or 0))
+
+        for root, items in by_root.items():
+            for sub in _iter_batches(items, REMOTE_HASH_SUBBATCH_FILES):
+                parallel, probe = tuner.next_parallel(ssh_client)
+                t0 = time.time()
+                hashed += _hash_remote_stream(ssh_client, host, algo, root,
+                                              [rel for rel, _ in sub], parallel, db, pbar, partial=partial)
+                elapsed = time.time() - t0
+                if partial:
+                    nbytes = sum(min(sz, 3 * PARTIAL_HASH_SEGMENT) for _, sz in sub)
+                else:
+                    nbytes = sum(sz for _, sz in sub)
+                rate = tuner.observe(nbytes, elapsed)
+                if DEBUG:
+                    load = f"load={probe[1]:.2f}/{probe[0]}" if probe else "load=?"
+                    print(f"[remote-{'phash' if partial else 'hash'}] P={parallel} {len(sub)} files, {_fmt_bytes(nbytes)} "
+                          f"in {elapsed:.1f}s ({_fmt_bytes(rate)}/s) {load}")
 
     if pbar:
         pbar.close()
     return hashed
 
 # ===================== Compare & Plan =====================
-def gather_local_hashes(root, algo, min_last_seen=None):
-    with sqlite3.connect(CACHE_DB) as db:
-        cur = db.cursor()
-        if min_last_seen:
-            cur.execute("""SELECT hash FROM filemeta_local
-                           WHERE root=? AND algo=? AND hash IS NOT NULL AND last_seen>=?""",
-                        (root, algo, min_last_seen))
-        else:
-            cur.execute("""SELECT hash FROM filemeta_local
-                           WHERE root=? AND algo=? AND hash IS NOT NULL""", (root, algo))
-        return {row[0] for row in cur.fetchall()}
+def _prune_deleted_rows(db, cutoff):
+    db.execute("DELETE FROM filemeta_local  WHERE last_seen < ?", (cutoff,))
+    db.execute("DELETE FROM filemeta_remote WHERE last_seen < ?", (cutoff,))
+    db.execute("DELETE FROM dirmeta_local   WHERE last_seen < ?", (cutoff,))
+    # thư mục không còn file nào (cả 2 phía) -> bỏ khỏi từ điển
+    db.execute("""DELETE FROM path_dir WHERE
+                  NOT EXISTS (SELECT 1 FROM filemeta_local  f WHERE f.dir_id=path_dir.id) AND
+                  NOT EXISTS (SELECT 1 FROM filemeta_remote f WHERE f.dir_id=path_dir.id) AND
+                  NOT EXISTS (SELECT 1 FROM plan_only_in_2  f WHERE f.dir_id=path_dir.id)""")
 
 def prune_deleted_records(ttl_seconds=7*24*3600):
-    cutoff = _now() - ttl_seconds
-    with sqlite3.connect(CACHE_DB) as db:
-        db.execute("DELETE FROM filemeta_local  WHERE last_seen < ?", (cutoff,))
-        db.execute("DELETE FROM filemeta_remote WHERE last_seen < ?", (cutoff,))
-        db.commit()
+    w = cache_writer()
+    w.submit(_prune_deleted_rows, _now() - ttl_seconds)
+    w.flush()
 
-def list_remote_hashed(host, roots, algo, min_last_seen=None):
-    with sqlite3.connect(CACHE_DB) as db:
-        db.row_factory = sqlite3.Row
-        cur = db.cursor()
-        if min_last_seen:
-            q = """SELECT root, rel, size, hash FROM filemeta_remote
-                   WHERE host=? AND algo=? AND hash IS NOT NULL AND last_seen>=?"""
-            cur.execute(q, (host, algo, min_last_seen))
-        else:
-            q = """SELECT root, rel, size, hash FROM filemeta_remote
-                   WHERE host=? AND algo=? AND hash IS NOT NULL"""
-            cur.execute(q, (host, algo))
-        rows = cur.fetchall()
-    # Return map hash -> [combined_rel], same map size & origin
+SIZE_UNIQUE_PREFIX = "size-unique:"
+PARTIAL_UNIQUE_PREFIX = "partial-unique:"
+
+def _is_content_hash(key):
+    """Key trong hash2/only_in_2 là hash nội dung thật (không phải key giả của size/partial prefilter)."""
+    return not key.startswith((SIZE_UNIQUE_PREFIX, PARTIAL_UNIQUE_PREFIX))
+
+def _remote_rows_to_maps(rows, roots, key_fn):
+    """rows (root, rel, size, mtime, hash) -> (key -> [combined_rel], combined_rel -> size,
+    combined_rel -> origin, combined_rel -> mtime)."""
     aliases = _derive_aliases(roots, SERVER2_ROOT_ALIASES)
     multiroot = len(roots) > 1
     hash_to_paths = {}
     size_map = {}
     origin_map = {}
+    mtime_map = {}
     for r in rows:
-        root = r["root"]; rel = r["rel"]; size = r["size"]; h = r["hash"]
+        root = r["root"]; rel = r["rel"]; size = r["size"]
         alias = aliases[roots.index(root)]
         combined_rel = os.path.join(alias, rel).replace("\\","/") if (multiroot and USE_MERGE_SUBROOT) else rel
-        hash_to_paths.setdefault(h, []).append(combined_rel)
+        hash_to_paths.setdefault(key_fn(r, combined_rel), []).append(combined_rel)
         size_map[combined_rel] = size
         origin_map[combined_rel] = (root, alias, rel)
-    return hash_to_paths, size_map, origin_map
-
-def compute_planned(server1_root, host, roots, algo, min_last_seen=None):
-    local_hashes = gather_local_hashes(server1_root, algo, min_last_seen=min_last_seen)
-    hash2, remote_rel_size, rel_origin = list_remote_hashed(host, roots, algo, min_last_seen=min_last_seen)
-   
-    set1 = set(local_hashes)
-    set2 = set(hash2.keys())
-    only_in_2 = set2 - set1
-
-    log_by_subfolder = defaultdict(lambda: {"files": 0, "bytes": 0})
-    total_files = 0
-    total_bytes = 0
+        mtime_map[combined_rel] = r["mtime"]
+    return hash_to_paths, size_map, origin_map, mtime_map
+
+def _plan_insert_sql(extra=""):
+    """SELECT các row remote (hash thật, vừa thấy) chưa có hash trùng ở local hiện hành."""
+    return f"""
+    INSERT OR REPLACE INTO plan_only_in_2(root_id, dir_id, name, algo, hash, size)
+    SELECT r.root_id, r.dir_id, r.name, r.algo, r.hash, r.size FROM filemeta_remote r
+    WHERE r.root_id IN {_HOST_ROOT_IDS_SQL} AND r.algo=? AND r.hash IS NOT NULL AND r.last_seen>=? {extra}
+      AND NOT EXISTS (SELECT 1 FROM filemeta_local l
+                      WHERE l.algo=r.algo AND l.hash=r.hash
+                        AND l.root_id={_LOCAL_ROOT_ID_SQL} AND l.last_seen>=?)"""
+
+def refresh_planned(server1_root, host, roots, algo, min_last_seen=None, local_min_last_seen=None):
+    """
+    Cập nhật bảng plan_only_in_2 theo delta từ lần plan trước:
+    - plan_dirty: hash vừa thêm/đổi/xoá/sống lại (trigger trên filemeta_local/filemeta_remote);
+    - row đã thấy ở lần plan trước nhưng không thấy ở vòng này (last_seen nằm giữa 2 mốc cutoff).
+    Chỉ tính lại các hash đó -> chi phí theo lượng thay đổi, không theo tổng số file.
+    Rebuild toàn bộ khi đổi cấu hình/algo, cutoff lùi, hoặc quá PLAN_FULL_REBUILD_EVERY.
+    Trả về số hash đã tính lại (None nếu rebuild).
+    """
+    c_remote = min_last_seen or 0
+    c_local = local_min_last_seen if local_min_last_seen is not None else c_remote
+    sig = json.dumps([server1_root, host, sorted(roots), algo])
+    aid = _algo_id(algo)
+    now = _now()
+    with cache_db() as db:
+        cur = db.cursor()
+        prev_local = _state_get(cur, "plan_cutoff:local")
+        prev_remote = _state_get(cur, "plan_cutoff:remote")
+        rebuild = (not PLAN_INCREMENTAL
+                   or _state_get(cur, "plan_sig") != sig
+                   or prev_local is None or prev_remote is None
+                   or c_local < prev_local or c_remote < prev_remote
+                   or now - _state_get(cur, "plan_rebuild_ts", 0) >= PLAN_FULL_REBUILD_EVERY)
+        recomputed = None
+        if rebuild:
+            cur.execute("DELETE FROM plan_only_in_2")
+            cur.execute(_plan_insert_sql(), (host, aid, c_remote, server1_root, c_local))
+            _state_set(cur, "plan_rebuild_ts", now)
+        else:
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS plan_delta(hash BLOB PRIMARY KEY) WITHOUT ROWID")
+            cur.execute("DELETE FROM plan_delta")
+            cur.execute("INSERT OR IGNORE INTO plan_delta SELECT hash FROM plan_dirty WHERE algo=?", (aid,))
+            cur.execute(f"""INSERT OR IGNORE INTO plan_delta
+                            SELECT hash FROM filemeta_local
+                            WHERE last_seen>=? AND last_seen<? AND root_id={_LOCAL_ROOT_ID_SQL}
+                              AND algo=? AND hash IS NOT NULL""",
+                        (prev_local, c_local, server1_root, aid))
+            cur.execute(f"""INSERT OR IGNORE INTO plan_delta
+                            SELECT hash FROM filemeta_remote
+                            WHERE last_seen>=? AND last_seen<? AND root_id IN {_HOST_ROOT_IDS_SQL}
+                              AND algo=? AND hash IS NOT NULL""",
+                        (prev_remote, c_remote, host, aid))
+            recomputed = cur.execute("SELECT COUNT(*) FROM plan_delta").fetchone()[0]
+            if recomputed:
+                cur.execute("""DELETE FROM plan_only_in_2
+                               WHERE algo=? AND hash IN (SELECT hash FROM plan_delta)""", (aid,))
+                cur.execute(_plan_insert_sql("AND r.hash IN (SELECT hash FROM plan_delta)"),
+                            (host, aid, c_remote, server1_root, c_local))
+            cur.execute("DELETE FROM plan_delta")
+        cur.execute("DELETE FROM plan_dirty WHERE algo=?", (aid,))
+        _state_set(cur, "plan_sig", sig)
+        _state_set(cur, "plan_cutoff:local", c_local)
+        _state_set(cur, "plan_cutoff:remote", c_remote)
+        db.commit()
+    return recomputed
+
+def list_remote_planned(host, roots, algo):
+    """plan_only_in_2 -> (hash -> [combined_rel], combined_rel -> size, combined_rel -> origin, combined_rel -> mtime)."""
+    with cache_db() as db:
+        cur = db.cursor()
+        cur.row_factory = sqlite3.Row
+        rows = cur.execute(f"""SELECT pr.root AS root, {_rel_sql("p")} AS rel, p.size AS size, r.mtime AS mtime,
+                                      p.hash AS hash
+                              FROM plan_only_in_2 p
+                              JOIN path_dir d ON d.id=p.dir_id
+                              JOIN path_root pr ON pr.id=p.root_id
+                              LEFT JOIN filemeta_remote r ON r.dir_id=p.dir_id AND r.name=p.name AND r.algo=p.algo
+                              WHERE pr.host=? AND p.algo=?""", (host, _algo_id(algo))).fetchall()
+    return _remote_rows_to_maps(rows, roots, lambda r, combined_rel: _hash_hex(r["hash"]))
+
+def _combined_subfolder(roots, aliases, root, path):
+    """Thư mục (rel) của file remote theo cách đặt tên ở local (có alias khi merge nhiều root)."""
+    if len(roots) > 1 and USE_MERGE_SUBROOT:
+        alias = aliases[roots.index(root)]
+        return f"{alias}/{path}" if path else alias
+    return path
+
+def planned_stats_by_dir(host, roots, algo):
+    """Thống kê planned (phần hash thật) theo thư mục: GROUP BY dir_id trên plan_only_in_2."""
+    aliases = _derive_aliases(roots, SERVER2_ROOT_ALIASES)
+    with cache_db() as db:
+        rows = db.execute("""SELECT pr.root, d.path, COUNT(*), COALESCE(SUM(p.size), 0)
+                             FROM plan_only_in_2 p
+                             JOIN path_dir d ON d.id=p.dir_id
+                             JOIN path_root pr ON pr.id=p.root_id
+                             WHERE pr.host=? AND p.algo=?
+                             GROUP BY p.dir_id""", (host, _algo_id(algo))).fetchall()
+    stats = defaultdict(lambda: {"files": 0, "bytes": 0})
+    for root, path, files, nbytes in rows:
+        entry = stats[_combined_subfolder(roots, aliases, root, path)]
+        entry["files"] += files
+        entry["bytes"] += nbytes
+    return stats
+
+def list_remote_size_unique(server1_root, host, roots, algo, min_last_seen=None, local_min_last_seen=None):
+    """
+    File remote chưa hash mà không file local hiện hành nào trùng size (hoặc trùng size nhưng
+    phash khác và local đã có phash) -> chắc chắn unique. Trả về cùng dạng list_remote_hashed
+    với key giả "size-unique:<combined_rel>" / "partial-unique:<combined_rel>".
+    """
+    with cache_db() as db:
+        cur = db.cursor()
+        cur.row_factory = sqlite3.Row
+        q = f"""SELECT pr.root AS root, {_rel_sql("r")} AS rel, r.size AS size, r.mtime AS mtime,
+                      r.hash AS hash, r.phash AS phash
+               FROM filemeta_remote r
+               JOIN path_dir d ON d.id=r.dir_id
+               JOIN path_root pr ON pr.id=r.root_id
+               WHERE pr.host=? AND r.algo=? AND r.hash IS NULL AND r.last_seen>=?
+                 AND NOT EXISTS (SELECT 1 FROM filemeta_local l
+                                 WHERE l.root_id={_LOCAL_ROOT_ID_SQL} AND l.algo=? AND l.size=r.size
+                                   AND l.last_seen>=?
+                                   AND (r.phash IS NULL OR l.phash IS NULL OR l.phash=r.phash))"""
+        aid = _algo_id(algo)
+        cur.execute(q, (host, aid, min_last_seen or 0, server1_root, aid, local_min_last_seen or 0))
+        rows = cur.fetchall()
+
+    def _key(r, combined_rel):
+        prefix = PARTIAL_UNIQUE_PREFIX if r["phash"] is not None else SIZE_UNIQUE_PREFIX
+        return prefix + combined_rel
+    return _remote_rows_to_maps(rows, roots, _key)
+
+def compute_planned(server1_root, host, roots, algo, min_last_seen=None, local_min_last_seen=None):
+    # barrier: mọi hash/metadata đã đẩy sang CacheWriter phải commit trước khi plan
+    cache_writer().flush()
+    if local_min_last_seen is None:
+        local_min_last_seen = min_last_seen
+    recomputed = refresh_planned(server1_root, host, roots, algo, min_last_seen, local_min_last_seen)
+    if DEBUG:
+        print("🧮 Planner: full rebuild" if recomputed is None else f"🧮 Planner: {recomputed} hash recomputed")
+    hash2, remote_rel_size, rel_origin, remote_rel_mtime = list_remote_planned(host, roots, algo)
+    # plan_only_in_2 chỉ chứa hash remote không có ở local -> mọi key đều thuộc only_in_2
+    only_in_2 = set(hash2)
+
+    if REMOTE_SIZE_PREFILTER:
+        by_size, size_map, origin_map, mtime_map = list_remote_size_unique(
+            server1_root, host, roots, algo, min_last_seen, local_min_last_seen)
+        hash2.update(by_size)
+        remote_rel_size.update(size_map)
+        rel_origin.update(origin_map)
+        remote_rel_mtime.update(mtime_map)
+        only_in_2 |= set(by_size)
+
+    # phần hash thật: GROUP BY dir_id trong SQL; key giả (size/partial-unique) cộng thêm ở Python
+    log_by_subfolder = planned_stats_by_dir(host, roots, algo)
     for h in only_in_2:
+        if _is_content_hash(h):
+            continue
         for rel in hash2[h]:
             sz = remote_rel_size.get(rel, 0)
             subfolder = os.path.dirname(rel)
             log_by_subfolder[subfolder]["files"] += 1
             log_by_subfolder[subfolder]["bytes"] += sz
-            total_files += 1
-            total_bytes += sz
+    total_files = sum(v["files"] for v in log_by_subfolder.values())
+    total_bytes = sum(v["bytes"] for v in log_by_subfolder.values())
 
     planned_stats = {
         "per_subfolder_planned": log_by_subfolder,
         "planned_files": total_files,
         "planned_bytes": total_bytes
     }
-    return hash2, only_in_2, remote_rel_size, rel_origin, planned_stats
+    return hash2, only_in_2, remote_rel_size, rel_origin, planned_stats, remote_rel_mtime
 
 # ===================== JSON LOG & Metrics =====================
 def _fmt_int(n):
@@ -561,7 +2250,8 @@ def build_merge_alert_markdown(
     failed_files, failed_bytes,
     conflict_files, conflict_bytes,
     log_path, use_merge_subroot=None, on_conflict=None,
-    run_id=None, duration_seconds=None, throughput_bps=None
+    run_id=None, duration_seconds=None, throughput_bps=None,
+    deferred_files=0, deferred_bytes=0
 ):
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     lines = []
@@ -580,6 +2270,8 @@ def build_merge_alert_markdown(
     lines.append(f"Copied            : { _fmt_int(copied_files) } files, { _fmt_int(copied_bytes) } bytes ({ _fmt_bytes(copied_bytes) })")
     lines.append(f"Failed            : { _fmt_int(failed_files) } files, { _fmt_int(failed_bytes) } bytes ({ _fmt_bytes(failed_bytes) })")
     lines.append(f"Conflict          : { _fmt_int(conflict_files) } files, { _fmt_int(conflict_bytes) } bytes ({ _fmt_bytes(conflict_bytes) })")
+    if deferred_files:
+        lines.append(f"Deferred (disk)   : { _fmt_int(deferred_files) } files, { _fmt_int(deferred_bytes) } bytes ({ _fmt_bytes(deferred_bytes) })")
     if duration_seconds is not None:
         lines.append(f"Duration          : {duration_seconds:.3f} s")
     if throughput_bps is not None:
@@ -592,7 +2284,7 @@ def save_json_log(json_path, duplicates, folder, backup_root, moved_status_map=N
                   rel_size_map=None, meta=None, errors_map=None):
     """
     moved_status_map[p] can be:
-    - str: "copied" | "failed" | ...
+    - str: "copied" | "failed" | "deferred_space" | ...
     - dict: {
     "status": "...",
     "source_alias": str,
@@ -601,7 +2293,11 @@ def save_json_log(json_path, duplicates, folder, backup_root, moved_status_map=N
     "dest": str, # destination path (absolute or base-relative)
     "bytes": int,
     "note": str,
-    "error": str
+    "error": str,
+    "transfer": {"engine": "pipelined" | "get" | "tar" | "zstd" | "hardlink" | "local_copy",
+                 "seconds": float, "bytes_per_second": int,
+                 "batch_files": int (tar), "wire_bytes": int (zstd), "source": rel_path đã tải (hardlink/local_copy)},
+    "verify": "verified" | "mismatch" | "unverified"  (hash tính lúc copy so với hash remote)
     }
     """
     log = {"hashes": []}
@@ -623,7 +2319,8 @@ def save_json_log(json_path, duplicates, folder, backup_root, moved_status_map=N
                 if isinstance(raw, dict):
                     status = raw.get("status", "pending")
                     # Collect useful extra fields
-                    for k in ("source_alias", "origin_root", "src_remote", "dest", "bytes", "note", "error"):
+                    for k in ("source_alias", "origin_root", "src_remote", "dest", "bytes", "note", "error",
+                              "transfer", "verify"):
                         if raw.get(k) is not None:
                             entry_extra[k] = raw[k]
                 elif isinstance(raw, str):
@@ -817,7 +2514,9 @@ def build_telegram_and_email_body(run_id, res):
         on_conflict=ON_CONFLICT,
         run_id=run_id,
         duration_seconds=res.get("duration_seconds"),
-        throughput_bps=res.get("throughput_bytes_per_second")
+        throughput_bps=res.get("throughput_bytes_per_second"),
+        deferred_files=res.get("deferred", 0),
+        deferred_bytes=res.get("bytes_deferred", 0)
     )
 
 def send_alerts_combined(run_id, res):
@@ -878,7 +2577,672 @@ def connect_ssh(host, port, username, password=None, keyfile=None, key_passphras
     return client
 
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
+# ===================== SFTP transfer =====================
+def open_sftp(ssh_client):
+    """Phiên SFTP với window/packet lớn (SFTP_WINDOW_SIZE, SFTP_MAX_PACKET_SIZE)."""
+    if not SFTP_PIPELINED:
+        return ssh_client.open_sftp()
+    return paramiko.SFTPClient.from_transport(ssh_client.get_transport(),
+                                              window_size=SFTP_WINDOW_SIZE,
+                                              max_packet_size=SFTP_MAX_PACKET_SIZE)
+
+def _sftp_readv_windows(rf, size):
+    """paramiko cũ (prefetch không giới hạn in-flight): readv từng cửa sổ SFTP_MAX_REQUESTS request."""
+    window = SFTP_REQUEST_SIZE * SFTP_MAX_REQUESTS
+    for start in range(0, size, window):
+        end = min(size, start + window)
+        yield from rf.readv([(off, min(SFTP_REQUEST_SIZE, end - off))
+                             for off in range(start, end, SFTP_REQUEST_SIZE)])
+
+def sftp_download(sftp, src_remote, dest_local, size, hasher=None, throttle=None):
+    """
+    Tải 1 file remote -> local. Trả về (bytes, seconds).
+    Pipelined: gửi trước tới SFTP_MAX_REQUESTS request READ cỡ SFTP_REQUEST_SIZE (prefetch) để
+    link trễ cao vẫn đầy băng thông, ghi local qua buffer SFTP_WRITE_BUFFER.
+    hasher (ContentHasher): nhận từng block khi ghi (chỉ chế độ pipelined; sftp.get() không có hook).
+    throttle (CopyThrottle): token bucket băng thông, cũng chỉ áp cho chế độ pipelined.
+    """
+    t0 = time.time()
+    if not SFTP_PIPELINED:
+        sftp.get(src_remote, dest_local)
+        return os.path.getsize(dest_local), time.time() - t0
+    nbytes = 0
+    try:
+        with sftp.open(src_remote, "rb") as rf, open(dest_local, "wb", buffering=SFTP_WRITE_BUFFER) as wf:
+            _preallocate(wf.fileno(), size)
+            rf.MAX_REQUEST_SIZE = SFTP_REQUEST_SIZE  # paramiko chia request theo thuộc tính này
+            try:
+                rf.prefetch(size, max_concurrent_requests=SFTP_MAX_REQUESTS)
+                chunks = iter(lambda: rf.read(SFTP_WRITE_BUFFER), b"")
+            except TypeError:  # paramiko < 3.3
+                chunks = _sftp_readv_windows(rf, size)
+            if throttle is not None:
+                chunks = throttle.iter(chunks)
+            for data in chunks:
+                wf.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+                nbytes += len(data)
+        if nbytes != size:
+            raise IOError(f"size mismatch: got {nbytes}, expected {size}")
+    except Exception:
+        # không để lại file dở (lần thử lại/vòng sau sẽ coi là conflict)
+        try:
+            os.remove(dest_local)
+        except OSError:
+            pass
+        raise
+    return nbytes, time.time() - t0
+
+def zstd_download(ssh_client, src_remote, dest_local, size, hasher=None, throttle=None):
+    """
+    Tải 1 file qua `zstd -c` ở remote, giải nén stream ở local (module zstandard, hoặc binary zstd).
+    Trả về (bytes, seconds, wire_bytes). hasher nhận bytes đã giải nén; throttle tính theo bytes nén (trên dây).
+    """
+    t0 = time.time()
+    cmd = f"zstd -q -c -{int(WIRE_COMPRESS_LEVEL)} -- {shlex.quote(src_remote)}"
+    stdin, stdout, stderr = ssh_client.exec_command(cmd, get_pty=False)
+    chan = stdout.channel
+    err_chunks = []
+    wire = [0]
+
+    def _counted():
+        for data in _iter_channel_chunks(chan, err_chunks):
+            wire[0] += len(data)
+            if throttle is not None:
+                throttle.consume(len(data))
+            yield data
+
+    nbytes, local_rc = 0, 0
+    try:
+        with open(dest_local, "wb", buffering=SFTP_WRITE_BUFFER) as wf:
+            _preallocate(wf.fileno(), size)
+            if HAVE_ZSTANDARD:
+                reader = zstandard.ZstdDecompressor().stream_reader(_ChunkReader(_counted()))
+                try:
+                    for data in iter(lambda: reader.read(SFTP_WRITE_BUFFER), b""):
+                        wf.write(data)
+                        if hasher is not None:
+                            hasher.update(data)
+                        nbytes += len(data)
+                except zstandard.ZstdError:
+                    local_rc = 1
+            else:
+                proc = subprocess.Popen(["zstd", "-q", "-d", "-c"], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                pump_errors = []
+
+                def _pump():
+                    try:
+                        for data in _counted():
+                            proc.stdin.write(data)
+                    except BrokenPipeError:
+                        pass  # zstd local đã thoát, lỗi báo qua exit code
+                    except Exception as e:
+                        pump_errors.append(e)
+                    finally:
+                        proc.stdin.close()
+
+                pump = threading.Thread(target=_pump, name="zstd-pump", daemon=True)
+                pump.start()
+                for data in iter(lambda: proc.stdout.read(SFTP_WRITE_BUFFER), b""):
+                    wf.write(data)
+                    if hasher is not None:
+                        hasher.update(data)
+                    nbytes += len(data)
+                pump.join()
+                local_rc = proc.wait()
+                if pump_errors:
+                    raise pump_errors[0]
+        # lỗi phía remote (file mất, không đọc được) báo trước lỗi giải nén mà nó gây ra
+        rc = chan.recv_exit_status()
+        if rc != 0:
+            err = b"".join(err_chunks).decode("utf-8", "ignore").strip()
+            if "No such file" in err:
+                # cùng errno như SFTP open -> _copy_attempt xếp vào failed_missing_remote
+                raise IOError(errno.ENOENT, f"remote zstd exit {rc}: {err}")
+            raise IOError(f"remote zstd exit {rc}: {err}")
+        if local_rc != 0:
+            raise IOError(f"local zstd -d exit {local_rc}")
+        if nbytes != size:
+            raise IOError(f"size mismatch: got {nbytes}, expected {size}")
+    except Exception:
+        try:
+            os.remove(dest_local)
+        except OSError:
+            pass
+        raise
+    return nbytes, time.time() - t0, wire[0]
+
+class WireCompression:
+    """
+    Chọn từng file có kéo qua zstd hay SFTP thường.
+    File nén được: theo extension, extension lạ thì probe đoạn đầu (kết quả nhớ theo extension).
+    auto: so throughput đo được (EWMA) của SFTP và zstd; chưa đo zstd thì so link với WIRE_COMPRESS_LINK_BPS;
+    chưa đo link thì đi SFTP trước để đo. Khi đang chọn SFTP, cứ WIRE_COMPRESS_REPROBE_EVERY file nén được
+    lại cho 1 file đi zstd để đo lại -> quyết định không bị khoá cả lần chạy khi link đổi tốc độ.
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._remote_ok = None
+        self._ext_ok = {}
+        self._bps = {"sftp": None, "zstd": None}
+        self._since_zstd = 0
+        self.reprobes = 0
+        self.files = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.local_ok = HAVE_ZSTANDARD or shutil.which("zstd") is not None
+        if mode != "off" and not self.local_ok:
+            print("⚠️ Thiếu zstd ở local (pip install zstandard hoặc cài zstd) — tắt nén đường truyền")
+
+    def observe(self, engine, nbytes, secs):
+        """Ghi nhận throughput 1 file (bytes gốc / giây); file nhỏ bị latency chi phối nên bỏ qua."""
+        if nbytes < WIRE_COMPRESS_MIN_SIZE or secs <= 0:
+            return
+        bps = nbytes / secs
+        with self._lock:
+            prev = self._bps[engine]
+            self._bps[engine] = bps if prev is None else 0.7 * prev + 0.3 * bps
+
+    def record(self, raw_bytes, wire_bytes):
+        with self._lock:
+            self.files += 1
+            self.raw_bytes += raw_bytes
+            self.wire_bytes += wire_bytes
+
+    def _link_slow(self):
+        if self.mode == "always":
+            return True
+        with self._lock:
+            sftp_bps, zstd_bps = self._bps["sftp"], self._bps["zstd"]
+        if sftp_bps is None:
+            return False
+        if zstd_bps is None:
+            return sftp_bps < WIRE_COMPRESS_LINK_BPS
+        return zstd_bps > sftp_bps
+
+    def _compressible(self, sftp, src_remote):
+        ext = os.path.splitext(src_remote)[1].lower()
+        if ext in WIRE_COMPRESS_SKIP_EXTS:
+            return False
+        if ext in WIRE_COMPRESS_EXTS:
+            return True
+        with self._lock:
+            known = self._ext_ok.get(ext) if ext else None
+        if known is not None:
+            return known
+        try:
+            with sftp.open(src_remote, "rb") as rf:
+                head = rf.read(WIRE_COMPRESS_PROBE_BYTES)
+        except IOError as e:
+            if isinstance(e, ConnectionError):
+                raise
+            return False
+        ok = bool(head) and len(zlib.compress(head, 1)) <= WIRE_COMPRESS_PROBE_RATIO * len(head)
+        if ext:
+            with self._lock:
+                self._ext_ok[ext] = ok
+        return ok
+
+    def _reprobe_due(self):
+        """SFTP đang thắng (hoặc zstd chưa đo): đủ WIRE_COMPRESS_REPROBE_EVERY file nén được -> thử zstd lại."""
+        if not WIRE_COMPRESS_REPROBE_EVERY:
+            return False
+        with self._lock:
+            if self._bps["sftp"] is None:
+                return False
+            self._since_zstd += 1
+            if self._since_zstd < WIRE_COMPRESS_REPROBE_EVERY:
+                return False
+            self._since_zstd = 0
+            self.reprobes += 1
+            return True
+
+    def _remote_available(self, pool):
+        # exec kiểm tra chạy ngoài lock: không chặn observe()/record() của các worker khác
+        with self._lock:
+            if self._remote_ok is not None:
+                return self._remote_ok
+        try:
+            with pool.client() as client:
+                out, _ = _ssh_exec(client, "command -v zstd >/dev/null 2>&1 && echo yes")
+            ok = out.strip() == "yes"
+        except Exception:
+            ok = False
+        with self._lock:
+            first = self._remote_ok is None
+            if first:
+                self._remote_ok = ok
+        if first and not ok:
+            print("⚠️ server2 không có zstd — tắt nén đường truyền")
+        return ok
+
+    def choose(self, sftp, pool, src_remote, size):
+        if self.mode == "off" or not self.local_ok or size < WIRE_COMPRESS_MIN_SIZE:
+            return False
+        slow = self._link_slow()
+        if not slow and self._bps["sftp"] is None:
+            return False  # chưa đo link: đi SFTP để đo, khỏi probe nội dung
+        if not self._compressible(sftp, src_remote):
+            return False
+        if not slow and not self._reprobe_due():
+            return False
+        if slow:
+            with self._lock:
+                self._since_zstd = 0
+        return self._remote_available(pool)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "files": self.files,
+                "raw_bytes": self.raw_bytes,
+                "wire_bytes": self.wire_bytes,
+                "ratio": round(self.wire_bytes / self.raw_bytes, 3) if self.raw_bytes else None,
+                "sftp_bps": round(self._bps["sftp"]) if self._bps["sftp"] else None,
+                "zstd_bps": round(self._bps["zstd"]) if self._bps["zstd"] else None,
+                "reprobes": self.reprobes,
+            }
+
+class CopyThrottle:
+    """
+    Giới hạn chung cho mọi job copy:
+    - consume(n): token bucket COPY_BANDWIDTH_LIMIT bytes/s (burst COPY_BANDWIDTH_BURST), ngủ khi hết token.
+    - reserve(n): giữ n bytes trong ngân sách COPY_MAX_INFLIGHT_BYTES suốt lúc tải 1 file/batch;
+      file lớn hơn cả ngân sách vẫn chạy được khi không còn gì đang tải.
+    """
+
+    def __init__(self, rate, burst, max_inflight):
+        self.rate = max(0, int(rate or 0))
+        self.burst = max(1, int(burst or 1))
+        self.max_inflight = max(0, int(max_inflight or 0))
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self.inflight = 0
+        self.peak_inflight = 0
+        self.bandwidth_wait = 0.0
+        self.inflight_wait = 0.0
+
+    def consume(self, n):
+        if not self.rate or n <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.bandwidth_wait += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def iter(self, chunks):
+        for data in chunks:
+            self.consume(len(data))
+            yield data
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes):
+        nbytes = max(0, int(nbytes or 0))
+        with self._cond:
+            if self.max_inflight:
+                t0 = time.monotonic()
+                while self.inflight and self.inflight + nbytes > self.max_inflight:
+                    self._cond.wait()
+                self.inflight_wait += time.monotonic() - t0
+            self.inflight += nbytes
+            self.peak_inflight = max(self.peak_inflight, self.inflight)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.inflight -= nbytes
+                self._cond.notify_all()
+
+    def stats(self):
+        return {
+            "bandwidth_limit_bps": self.rate,
+            "bandwidth_wait_seconds": round(self.bandwidth_wait, 3),
+            "max_inflight_bytes": self.max_inflight,
+            "peak_inflight_bytes": self.peak_inflight,
+            "inflight_wait_seconds": round(self.inflight_wait, 3),
+        }
+
+class DiskAdmission:
+    """
+    Giữ chỗ trên filesystem đích cho từng task copy trước khi tải:
+    try_reserve(n) chỉ nhận khi free thực tế (shutil.disk_usage, đọc lại mỗi lần) - lề an toàn
+    - tổng bytes đang giữ >= n; không đủ -> task bị hoãn (vòng sau plan lại vì file vẫn chưa có ở local).
+    Bytes đang ghi dở vừa bị trừ khỏi free vừa còn trong phần giữ chỗ -> đếm 2 lần, tức là dè dặt hơn
+    chứ không bao giờ nhận quá; release(n) sau khi file commit xong hoặc lỗi.
+    """
+
+    def __init__(self, path, margin_bytes, margin_pct, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        total, _, free = shutil.disk_usage(path)
+        self.margin = max(int(margin_bytes or 0), int(total * float(margin_pct or 0)))
+        self.free_start = free
+        self._lock = threading.Lock()
+        self.reserved = 0
+        self.peak_reserved = 0
+        self.refused = 0
+
+    def available(self):
+        """Bytes còn nhận được ngay lúc này (có thể âm khi đã lấn vào lề)."""
+        return shutil.disk_usage(self.path).free - self.margin - self.reserved
+
+    def try_reserve(self, nbytes):
+        nbytes = max(0, int(nbytes or 0))
+        with self._lock:
+            if self.enabled and nbytes > self.available():
+                self.refused += 1
+                return False
+            self.reserved += nbytes
+            self.peak_reserved = max(self.peak_reserved, self.reserved)
+            return True
+
+    def release(self, nbytes):
+        with self._lock:
+            self.reserved -= max(0, int(nbytes or 0))
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "margin_bytes": self.margin,
+            "free_bytes_start": self.free_start,
+            "peak_reserved_bytes": self.peak_reserved,
+            "refused": self.refused,
+        }
+
+# os.link lỗi vì filesystem (khác device, không quyền/không hỗ trợ hardlink, quá số link) -> copy local được;
+# lỗi khác (EEXIST, ENOENT, ENOSPC...) không được che bằng copy đè lên đích
+_LINK_FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP}
+
+class LocalDirCache:
+    """
+    Thư mục đích trong 1 lần merge: mỗi thư mục chỉ listdir (hoặc makedirs nếu chưa có) 1 lần,
+    exists() trả lời từ tập tên đã liệt kê + tên do chính lần chạy này tạo -> không stat từng file.
+    Tiện danh sách vừa liệt kê: xoá file tạm `.*.merge-*.tmp` của tiến trình đã chết (kill/OOM/mất điện giữa copy).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = {}
+        self._dir_locks = {}
+        self.listed = 0
+        self.created = 0
+        self.swept = 0
+
+    def _sweep_stale_tmp(self, d, names):
+        for name in [n for n in names if _merge_tmp_pid(n) is not None]:
+            pid = _merge_tmp_pid(name)
+            if pid == os.getpid():
+                continue  # file tạm của chính lần chạy này (đang ghi)
+            try:
+                os.kill(pid, 0)
+                continue  # tiến trình đó vẫn sống
+            except ProcessLookupError:
+                pass
+            except OSError:
+                continue  # không có quyền kiểm tra -> coi như còn sống
+            try:
+                os.remove(os.path.join(d, name))
+            except OSError:
+                continue
+            with self._lock:
+                self.swept += 1
+            names.discard(name)
+
+    def _load(self, d):
+        """Tập tên của thư mục d. listdir/makedirs chạy ngoài _lock chung (chỉ giữ lock riêng của d):
+        thư mục lớn hay NFS chậm không chặn worker đang hỏi các thư mục khác."""
+        with self._lock:
+            names = self._names.get(d)
+            if names is not None:
+                return names
+            dir_lock = self._dir_locks.setdefault(d, threading.Lock())
+        with dir_lock:
+            with self._lock:
+                names = self._names.get(d)
+            if names is not None:
+                return names  # thread khác vừa liệt kê xong
+            try:
+                names = set(os.listdir(d))
+                listed = True
+                self._sweep_stale_tmp(d, names)
+            except FileNotFoundError:
+                os.makedirs(d, exist_ok=True)
+                names = set()
+                listed = False
+            with self._lock:
+                if listed:
+                    self.listed += 1
+                else:
+                    self.created += 1
+                self._names[d] = names
+            return names
+
+    def ensure_dir(self, d):
+        self._load(d)
+
+    def exists(self, path):
+        d, name = os.path.split(path)
+        names = self._load(d)
+        with self._lock:
+            return name in names
+
+    def add(self, path):
+        d, name = os.path.split(path)
+        names = self._load(d)
+        with self._lock:
+            names.add(name)
+
+    def dirs(self):
+        with self._lock:
+            return list(self._names)
+
+def _tmp_path(dest_local):
+    """Tên file tạm cùng thư mục với đích (rename trong cùng filesystem là atomic)."""
+    d, name = os.path.split(dest_local)
+    return os.path.join(d, f".{name}.merge-{os.getpid()}-{threading.get_ident()}.tmp")
+
+def _syncfs(path):
+    """syncfs(2) cho filesystem chứa path; False nếu libc không có (không phải Linux/glibc cũ)."""
+    try:
+        fn = ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return fn(fd) == 0
+    finally:
+        os.close(fd)
+
+def _preallocate(fd, size):
+    """
+    fallocate(2) KEEP_SIZE cho file sắp ghi (>= PREALLOCATE_MIN_SIZE): filesystem cấp trước extent
+    liền mạch, file lớn ít phân mảnh, hết chỗ thì báo ENOSPC ngay thay vì giữa chừng.
+    Filesystem/libc không hỗ trợ thì bỏ qua (không dùng posix_fallocate: glibc giả lập bằng cách ghi 0).
+    """
+    if not PREALLOCATE_MIN_SIZE or size < PREALLOCATE_MIN_SIZE:
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fn = getattr(libc, "fallocate64", None) or libc.fallocate
+    except (OSError, AttributeError):
+        return False
+    fn.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    if fn(fd, 1, 0, size) == 0:  # 1 = FALLOC_FL_KEEP_SIZE: size file vẫn tăng theo bytes thật đã ghi
+        return True
+    err = ctypes.get_errno()
+    if err == errno.ENOSPC:
+        raise OSError(err, os.strerror(err))
+    return False
+
+def _fsync_path(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def sync_copied(files, dirs, mode=None):
+    """
+    Đẩy file vừa copy xuống đĩa 1 lần cuối vòng thay vì fsync từng file lúc ghi.
+    syncfs: 1 lần cho mỗi filesystem (nhóm thư mục theo st_dev); không có syncfs thì fsync
+    từng file rồi từng thư mục (để entry rename cũng bền). Trả về cách đã dùng.
+    """
+    mode = mode or COPY_FSYNC
+    if mode == "off" or not files:
+        return "off"
+    if mode == "syncfs":
+        by_dev = {}
+        for d in dirs:
+            try:
+                by_dev.setdefault(os.stat(d).st_dev, d)
+            except OSError:
+                pass
+        if by_dev and all(_syncfs(d) for d in by_dev.values()):
+            return "syncfs"
+    for path in files:
+        _fsync_path(path)
+    for d in dirs:
+        _fsync_path(d)
+    return "fsync"
+
+class _SSHSlot:
+    def __init__(self, client, owned):
+        self.client = client
+        self.owned = owned        # False: connection của caller, pool không đóng
+        self.lock = threading.Lock()
+        self.active = 0
+        self.idle = []            # phiên SFTP rảnh, dùng lại cho job sau
+        self.files = 0
+        self.reconnects = 0
+
+class SSHPool:
+    """
+    N transport SSH độc lập tới server2 cho copy song song (mỗi transport 1 TCP + 1 thread mã hoá,
+    không dồn mọi job vào 1 stream). Slot 0 là connection sẵn có; các slot khác mở lười khi cần.
+    session(): mượn 1 phiên SFTP trên slot đang ít job nhất; kiểm tra transport còn sống
+    (is_active) và reconnect nếu đã rớt. Phiên SFTP được giữ lại cho job sau trên cùng slot.
+    """
+
+    class Lost(Exception):
+        """Job lỗi và transport của nó đã chết -> có thể thử lại trên phiên khác."""
+
+    def __init__(self, primary, size, connect):
+        self._connect = connect
+        self._lock = threading.Lock()
+        self.slots = [_SSHSlot(primary, False)] + [_SSHSlot(None, True) for _ in range(max(1, int(size)) - 1)]
+
+    @staticmethod
+    def _alive(client):
+        t = client.get_transport() if client is not None else None
+        return t is not None and t.is_active()
+
+    def _ensure(self, slot):
+        """Health check + reconnect (ngoài lock chung: handshake chậm không chặn slot khác)."""
+        with slot.lock:
+            if self._alive(slot.client):
+                return slot.client
+            stale, slot.idle = slot.idle, []
+            for sftp in stale:
+                try:
+                    sftp.close()
+                except Exception:
+                    pass
+            if slot.client is not None:
+                slot.reconnects += 1
+                if slot.owned:
+                    try:
+                        slot.client.close()
+                    except Exception:
+                        pass
+            slot.client = self._connect()
+            slot.owned = True
+            return slot.client
+
+    def _pick(self):
+        with self._lock:
+            slot = min(self.slots, key=lambda sl: sl.active)
+            slot.active += 1
+        return slot
+
+    def _release(self, slot):
+        with self._lock:
+            slot.active -= 1
+
+    @contextlib.contextmanager
+    def client(self):
+        """Mượn 1 SSHClient còn sống (cho exec_command, vd luồng tar)."""
+        slot = self._pick()
+        try:
+            yield self._ensure(slot)
+        except Exception as e:
+            if not isinstance(e, SSHPool.Lost) and not self._alive(slot.client):
+                raise SSHPool.Lost(str(e)) from e
+            raise
+        finally:
+            self._release(slot)
+
+    @contextlib.contextmanager
+    def session(self):
+        slot = self._pick()
+        sftp = None
+        try:
+            client = self._ensure(slot)
+            with slot.lock:
+                sftp = slot.idle.pop() if slot.idle else None
+            if sftp is None:
+                sftp = open_sftp(client)
+            yield sftp
+        except Exception as e:
+            if sftp is not None:
+                try:
+                    sftp.close()
+                except Exception:
+                    pass
+                sftp = None
+            if not isinstance(e, SSHPool.Lost) and not self._alive(slot.client):
+                raise SSHPool.Lost(str(e)) from e
+            raise
+        finally:
+            if sftp is not None:
+                with slot.lock:
+                    slot.idle.append(sftp)
+                    slot.files += 1
+            self._release(slot)
+
+    def stats(self):
+        return [{"files": sl.files, "reconnects": sl.reconnects} for sl in self.slots if sl.client is not None]
+
+    def close(self):
+        for slot in self.slots:
+            for sftp in slot.idle:
+                try:
+                    sftp.close()
+                except Exception:
+                    pass
+            slot.idle = []
+            if slot.owned and slot.client is not None:
+                try:
+                    slot.client.close()
+                except Exception:
+                    pass
+
 import uuid
 
 def confirm_and_merge(
@@ -892,12 +3256,17 @@ def confirm_and_merge(
     rel_origin,
     planned_stats,
     run_id,
-    auto=True
+    auto=True,
+    algo=None,
+    remote_rel_mtime=None
 ):
     """
     Copy unique files từ remote -> local theo kế hoạch (only_in_2).
     Hỗ trợ ON_CONFLICT: skip | overwrite | suffix | version.
-    Chạy sao chép đa luồng (ThreadPoolExecutor), mỗi job mở 1 SFTP riêng.
+    Chạy sao chép đa luồng (ThreadPoolExecutor), job mượn phiên SFTP từ SSHPool
+    (SSH_POOL_SIZE transport độc lập, tự reconnect khi rớt).
+    algo: thuật toán hash của vòng này; nếu có (và COPY_SEED_LOCAL_CACHE) file được hash ngay lúc copy,
+    đối chiếu với hash remote và ghi thẳng row filemeta_local -> vòng sau không phải đọc lại.
     """
     subroot = "merge_from_server2"
     dest_base = os.path.join(server1_root, subroot) if USE_MERGE_SUBROOT else server1_root
@@ -927,6 +3296,7 @@ def confirm_and_merge(
         "target_fs_used_bytes": fs["used"],
         "target_fs_free_bytes": fs["free"],
         "on_conflict": ON_CONFLICT,
+        "sftp_engine": "pipelined" if SFTP_PIPELINED else "get",
     }
     save_json_log(json_log_path, planned, server1_root, dest_base, None, remote_rel_size, meta)
 
@@ -947,18 +3317,172 @@ def confirm_and_merge(
     copied_files = copied_bytes = 0
     failed_files = failed_bytes = 0
     conflict_files = conflict_bytes = 0
+    deferred_files = deferred_bytes = 0
 
     os.makedirs(dest_base, exist_ok=True)
 
+    # Giữ chỗ đĩa đích theo từng task (free thực tế - lề an toàn); task không vừa -> hoãn sang vòng sau
+    admission = DiskAdmission(dest_base, DISK_SAFETY_MARGIN_BYTES, DISK_SAFETY_MARGIN_PCT,
+                              enabled=DISK_ADMISSION_ENABLED)
+    if DISK_ADMISSION_ENABLED and planned_bytes > admission.available():
+        print(f"⚠️ Target free space {_fmt_bytes(admission.free_start)} (margin {_fmt_bytes(admission.margin)}) "
+              f"< planned {_fmt_bytes(planned_bytes)} — files that do not fit are deferred to the next cycle")
+
     # Danh sách task thực sự sẽ copy
     tasks = []
     for h, rel_list in planned.items():
         for rel_path in rel_list:
             tasks.append((h, rel_path))
 
-    # ---------- inner function: mỗi job mở SFTP riêng ----------
+    # Cùng hash nội dung: chỉ tải path đầu tiên, các path còn lại chờ nó xong rồi link (dup_followers)
+    fetch_tasks, dup_followers = tasks, {}
+    if LINK_DUPLICATES:
+        fetch_tasks = []
+        for h, rel_list in planned.items():
+            rels = sorted(rel_list)
+            if len(rels) > 1 and _is_content_hash(h):
+                fetch_tasks.append((h, rels[0]))
+                dup_followers[rels[0]] = rels[1:]
+            else:
+                fetch_tasks.extend((h, rel_path) for rel_path in rels)
+    dedup = {"linked_files": 0, "local_copied_files": 0, "bytes_saved": 0}
+
+    # Hash trong lúc copy -> row filemeta_local (blake3 thiếu module thì _hash_new ra sha256: không seed)
+    seed_algo = algo if (COPY_SEED_LOCAL_CACHE and algo and (algo != "blake3" or HAVE_BLAKE3)) else None
+    rel_hash = {rel_path: h for h, rel_list in planned.items() if _is_content_hash(h) for rel_path in rel_list}
+    seed = {"files": 0, "verified": 0, "mismatch": 0, "unverified": 0}
+    seed_rows = []
+    written = []  # path local đã commit (rename) trong vòng này -> sync_copied cuối vòng
+
+    # ---------- inner function: mỗi job mượn 1 phiên SFTP từ pool ----------
     active = 0
     active_lock = threading.Lock()
+    max_workers = max(1, int(MAX_WORKERS))
+    pool = SSHPool(ssh_client2, min(SSH_POOL_SIZE, max_workers), lambda: connect_ssh(
+        SERVER2_HOST, SERVER2_PORT, SERVER2_USER,
+        password=SERVER2_PASSWORD, keyfile=SERVER2_KEY_FILE, key_passphrase=SERVER2_KEY_PASSPHRASE))
+    wire = WireCompression(WIRE_COMPRESS)
+    throttle = CopyThrottle(COPY_BANDWIDTH_LIMIT, COPY_BANDWIDTH_BURST, COPY_MAX_INFLIGHT_BYTES)
+
+    dir_cache = LocalDirCache()
+    remote_rel_mtime = remote_rel_mtime or {}
+
+    def _pick_dest(rel_path, tname, dest_local_base, remote_mtime):
+        """Đích theo ON_CONFLICT -> (dest_local, versioned, existed); dest_local None = skip.
+        remote_mtime(): mtime file nguồn, chỉ gọi khi cần đặt tên bản version.
+        Tồn tại hay không hỏi LocalDirCache (listdir 1 lần mỗi thư mục), không stat từng file."""
+        if not dir_cache.exists(dest_local_base):
+            return dest_local_base, False, False
+        if ON_CONFLICT == "skip":
+            if DEBUG:
+                print(f"[DBG][{tname}] skip-conflict {rel_path}")
+            return None, False, True
+        if ON_CONFLICT == "overwrite":
+            if DEBUG:
+                print(f"[DBG][{tname}] overwrite-conflict {rel_path}")
+            return dest_local_base, False, True
+        dest_local = conflict_suffix_path(dest_local_base, ts_epoch=remote_mtime())
+        dir_cache.ensure_dir(os.path.dirname(dest_local))
+        if DEBUG:
+            print(f"[DBG][{tname}] versioned -> {dest_local}")
+        return dest_local, True, True
+
+    def _commit(tmp, dest_local, mtime):
+        """File tạm đã ghi đủ -> giữ mtime remote, rename atomic đè lên đích (không còn file dở ở path thật)."""
+        try:
+            if mtime is not None:
+                os.utime(tmp, (mtime, mtime))
+            os.replace(tmp, dest_local)
+        except Exception:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        dir_cache.add(dest_local)
+
+    def _deferred(rel_path):
+        src_root, alias, orig_rel = rel_origin.get(rel_path, (None, None, rel_path))
+        return {
+            "rel_path": rel_path, "status": "deferred_space", "alias": alias, "src_root": src_root,
+            "src_remote": f"{(src_root or '').rstrip('/')}/{orig_rel}", "dest_rel": rel_path,
+            "bytes": remote_rel_size.get(rel_path, 0),
+            "note": "not enough free space on target, deferred to next cycle",
+        }
+
+    def _copy_attempt(sftp, rel_path, tname, src_root, alias, src_remote, dest_local_base, size):
+        res = {
+            "rel_path": rel_path, "alias": alias, "src_root": src_root, "src_remote": src_remote,
+            "dest_rel": os.path.relpath(dest_local_base, dest_base), "bytes": size
+        }
+        # size/mtime đã có trong filemeta_remote (metadata vòng này); chỉ stat khi thiếu mtime
+        mtime = remote_rel_mtime.get(rel_path)
+        if mtime is None:
+            try:
+                st_src = sftp.stat(src_remote)
+            except IOError as e:
+                if isinstance(e, ConnectionError):
+                    raise  # rớt kết nối, không phải file thiếu -> để pool thử lại
+                if DEBUG:
+                    print(f"[DBG][{tname}] missing remote: {src_remote} ({e})")
+                res.update(status="failed_missing_remote", error=f"remote-missing: {e}")
+                return res
+            size, mtime = st_src.st_size, st_src.st_mtime
+            res["bytes"] = size  # size trong plan có thể đã cũ; báo theo stat vừa đọc
+
+        # xử lý conflict
+        dest_local, versioned, existed = _pick_dest(rel_path, tname, dest_local_base, lambda: mtime)
+        if dest_local is None:
+            res["status"] = "skipped_conflict"
+            return res
+        res["dest_rel"] = os.path.relpath(dest_local, dest_base)
+
+        # copy vào file tạm; file remote đã mất thì open báo ENOENT (không stat trước)
+        if DEBUG:
+            print(f"[DBG][{tname}] GET {src_remote} -> {dest_local}")
+        tmp = _tmp_path(dest_local)
+        hasher = None
+        if seed_algo:
+            hasher = ContentHasher(seed_algo, size)
+        try:
+            if wire.choose(sftp, pool, src_remote, size):
+                with throttle.reserve(size), pool.client() as client:
+                    nbytes, secs, wire_bytes = zstd_download(client, src_remote, tmp, size, hasher, throttle)
+                wire.observe("zstd", nbytes, secs)
+                wire.record(nbytes, wire_bytes)
+                engine = "zstd"
+            else:
+                with throttle.reserve(size):
+                    nbytes, secs = sftp_download(sftp, src_remote, tmp, size, hasher, throttle)
+                if not SFTP_PIPELINED:
+                    hasher = None
+                wire.observe("sftp", nbytes, secs)
+                wire_bytes = None
+                engine = "pipelined" if SFTP_PIPELINED else "get"
+        except IOError as e:
+            if (isinstance(e, ConnectionError) or e.errno != errno.ENOENT
+                    or getattr(e, "filename", None) == tmp):
+                raise
+            if DEBUG:
+                print(f"[DBG][{tname}] missing remote: {src_remote} ({e})")
+            res.update(status="failed_missing_remote", error=f"remote-missing: {e}")
+            return res
+        _commit(tmp, dest_local, mtime)
+        res["bytes"] = nbytes  # bytes thật đã ghi (sftp.get() cũng trả size file local)
+        res["transfer"] = {
+            "engine": engine,
+            "seconds": round(secs, 3),
+            "bytes_per_second": round(nbytes / secs) if secs > 0 else None,
+            **({"wire_bytes": wire_bytes} if wire_bytes is not None else {}),
+        }
+        res["digests"] = hasher.hexdigests() if hasher else None
+        res["local_meta"] = (nbytes, int(mtime))
+
+        if versioned:
+            res.update(status="conflict_versioned", note="created versioned copy due to conflict")
+        else:
+            res["status"] = "copied_overwrite" if (existed and ON_CONFLICT == "overwrite") else "copied"
+        return res
 
     def _copy_one(rel_path: str):
         # Thông tin thread
@@ -972,6 +3496,10 @@ def confirm_and_merge(
         dest_local_base = os.path.join(dest_base, dest_rel)
         size = remote_rel_size.get(rel_path, 0)
 
+        # Giữ chỗ trên đĩa đích trước khi tải; không đủ -> hoãn
+        if not admission.try_reserve(size):
+            return _deferred(rel_path)
+
         # Đánh dấu "đang chạy"
         nonlocal active
         if DEBUG:
@@ -980,98 +3508,268 @@ def confirm_and_merge(
                 cur = active
             print(f"[DBG][{tname} tid={tid}] start {rel_path} (active={cur})")
 
-        sftp = ssh_client2.open_sftp()
         try:
-            os.makedirs(os.path.dirname(dest_local_base), exist_ok=True)
-
-            # xử lý conflict
-            dest_local = dest_local_base
-            versioned = False
-            if os.path.exists(dest_local):
-                if ON_CONFLICT == "skip":
-                    if DEBUG:
-                        print(f"[DBG][{tname}] skip-conflict {rel_path}")
-                    return {
-                        "rel_path": rel_path, "status": "skipped_conflict", "alias": alias,
-                        "src_root": src_root, "src_remote": src_remote,
-                        "dest_rel": os.path.relpath(dest_local, dest_base),
-                        "bytes": size
-                    }
-                elif ON_CONFLICT == "overwrite":
-                    if DEBUG:
-                        print(f"[DBG][{tname}] overwrite-conflict {rel_path}")
-                else:
-                    try:
-                        st_for_name = sftp.stat(src_remote)
-                        ts_epoch = getattr(st_for_name, "st_mtime", None)
-                    except Exception:
-                        ts_epoch = None
-                    dest_local = conflict_suffix_path(dest_local, ts_epoch=ts_epoch)
-                    os.makedirs(os.path.dirname(dest_local), exist_ok=True)
-                    versioned = True
-                    if DEBUG:
-                        print(f"[DBG][{tname}] versioned -> {dest_local}")
-
-            # verify remote
-            try:
-                sftp.stat(src_remote)
-            except IOError as e:
-                if DEBUG:
-                    print(f"[DBG][{tname}] missing remote: {src_remote} ({e})")
-                return {
-                    "rel_path": rel_path, "status": "failed_missing_remote", "alias": alias,
-                    "src_root": src_root, "src_remote": src_remote,
-                    "dest_rel": os.path.relpath(dest_local, dest_base),
-                    "bytes": size, "error": f"remote-missing: {e}"
-                }
-
-            # copy
-            if DEBUG:
-                print(f"[DBG][{tname}] GET {src_remote} -> {dest_local}")
-            sftp.get(src_remote, dest_local)
-
-            # preserve times
-            try:
-                st = sftp.stat(src_remote)
-                os.utime(dest_local, (st.st_atime, st.st_mtime))
-            except Exception:
-                pass
-
-            if versioned:
-                return {
-                    "rel_path": rel_path, "status": "conflict_versioned", "alias": alias,
-                    "src_root": src_root, "src_remote": src_remote,
-                    "dest_rel": os.path.relpath(dest_local, dest_base),
-                    "bytes": size, "note": "created versioned copy due to conflict"
-                }
-            else:
-                status = "copied_overwrite" if (os.path.exists(dest_local_base) and ON_CONFLICT == "overwrite") else "copied"
-                return {
-                    "rel_path": rel_path, "status": status, "alias": alias,
-                    "src_root": src_root, "src_remote": src_remote,
-                    "dest_rel": os.path.relpath(dest_local, dest_base),
-                    "bytes": size
-                }
-
-        except Exception as e:
+            for attempt in range(SSH_POOL_RETRIES + 1):
+                try:
+                    with pool.session() as sftp:
+                        return _copy_attempt(sftp, rel_path, tname, src_root, alias, src_remote,
+                                             dest_local_base, size)
+                except SSHPool.Lost as e:
+                    err = f"transport-lost: {e}"
+                    if attempt < SSH_POOL_RETRIES:
+                        print(f"⚠️ SSH transport lost while copying {rel_path} ({e}) — retry {attempt + 1}/{SSH_POOL_RETRIES}")
+                except OSError as e:
+                    if e.errno == errno.ENOSPC:
+                        # đĩa đầy dù đã giữ chỗ (tiến trình khác ghi vào): file tạm đã xoá, để vòng sau
+                        return _deferred(rel_path)
+                    err = str(e)
+                    break
+                except Exception as e:
+                    err = str(e)
+                    break
             return {
                 "rel_path": rel_path, "status": "failed", "alias": alias,
                 "src_root": src_root, "src_remote": src_remote,
                 "dest_rel": os.path.relpath(dest_local_base, dest_base),
-                "bytes": size, "error": str(e)
+                "bytes": size, "error": err
             }
         finally:
-            try:
-                sftp.close()
-            except Exception:
-                pass
+            admission.release(size)
             if DEBUG:
                 with active_lock:
                     active -= 1
                     cur = active
                 print(f"[DBG][{tname} tid={tid}] end   {rel_path} (active={cur})")
+
+    def _copy_tar_batch(src_root, rel_paths):
+        """
+        Kéo 1 batch file nhỏ cùng root bằng 1 luồng `tar -cf -` (exec_command), giải nén stream ở local:
+        không mở SFTP/stat từng file, mtime lấy từ header tar. Trả về list kết quả như _copy_one.
+        File không có trong luồng (thiếu trên remote, luồng lỗi giữa chừng) -> copy từng file bằng _copy_one.
+        Cả batch không vừa chỗ trống đĩa đích -> cũng qua _copy_one để file nào vừa thì vẫn copy.
+        """
+        tname = threading.current_thread().name
+        batch_bytes = sum(remote_rel_size.get(r, 0) for r in rel_paths)
+        if not admission.try_reserve(batch_bytes):
+            return [_copy_one(r) for r in rel_paths]
+        by_member = {rel_origin.get(r, (None, None, r))[2]: r for r in rel_paths}
+        results = {}
+        err_chunks = []
+        t0 = time.time()
+        try:
+            with throttle.reserve(batch_bytes), pool.client() as client:
+                root_esc = src_root.replace("'", "'\\''")
+                cmd = f"tar -C '{root_esc}' -cf - --null --no-recursion -T -"
+                stdin, stdout, stderr = client.exec_command(cmd, get_pty=False)
+                feed_errors = []
+                feeder = threading.Thread(target=_feed_stdin, args=(stdin, list(by_member), feed_errors),
+                                          name="tar-feed", daemon=True)
+                feeder.start()
+                reader = _ChunkReader(throttle.iter(_iter_channel_chunks(stdout.channel, err_chunks)))
+                with tarfile.open(fileobj=reader, mode="r|", bufsize=256 * 1024) as tf:
+                    for member in tf:
+                        name = member.name[2:] if member.name.startswith("./") else member.name
+                        rel_path = by_member.get(name)
+                        if rel_path is None or rel_path in results or not member.isreg():
+                            continue
+                        results[rel_path] = _extract_tar_member(tf, member, rel_path, tname, src_root)
+                feeder.join(timeout=10)
+        except Exception as e:
+            print(f"⚠️ tar batch {src_root}: {e} — {len(rel_paths) - len(results)} file copy từng file")
+        finally:
+            admission.release(batch_bytes)
+
+        secs = time.time() - t0
+        from_tar = [r for r in results.values() if "transfer" in r]
+        nbytes = sum(r["bytes"] for r in from_tar)
+        transfer = {"engine": "tar", "seconds": round(secs, 3),
+                    "bytes_per_second": round(nbytes / secs) if secs > 0 else None,
+                    "batch_files": len(rel_paths)}
+        for r in from_tar:
+            r["transfer"] = transfer
+        err = b"".join(err_chunks).decode("utf-8", "ignore").strip()
+        if DEBUG and err:
+            print(f"[DBG][{tname}] tar {src_root}: {err.splitlines()[0]} (+{len(err.splitlines()) - 1} lines)")
+        return list(results.values()) + [_copy_one(r) for r in rel_paths if r not in results]
+
+    def _extract_tar_member(tf, member, rel_path, tname, src_root):
+        _, alias, orig_rel = rel_origin.get(rel_path, (src_root, None, rel_path))
+        src_remote = f"{src_root.rstrip('/')}/{orig_rel}"
+        dest_local_base = os.path.join(dest_base, rel_path)
+        size = remote_rel_size.get(rel_path, member.size)
+        dest_local, versioned, existed = _pick_dest(rel_path, tname, dest_local_base, lambda: member.mtime)
+        res = {
+            "rel_path": rel_path, "alias": alias, "src_root": src_root, "src_remote": src_remote,
+            "dest_rel": os.path.relpath(dest_local or dest_local_base, dest_base), "bytes": size
+        }
+        if dest_local is None:
+            res["status"] = "skipped_conflict"
+            return res
+        hasher = ContentHasher(seed_algo, member.size) if seed_algo else None
+        tmp = _tmp_path(dest_local)
+        try:
+            src = tf.extractfile(member)
+            with open(tmp, "wb", buffering=SFTP_WRITE_BUFFER) as wf:
+                while True:
+                    try:
+                        data = src.read(HASH_CHUNK)
+                    except Exception as e:
+                        # luồng tar đứt giữa member: bỏ file dở, ném lên để _copy_tar_batch dừng luồng
+                        # và member này (không có trong results) đi đường SFTP từng file như phần còn lại
+                        wf.close()
+                        os.remove(tmp)
+                        raise _TarStreamError(f"{rel_path}: {e}") from e
+                    if not data:
+                        break
+                    wf.write(data)
+                    if hasher is not None:
+                        hasher.update(data)
+            _commit(tmp, dest_local, member.mtime)
+        except _TarStreamError:
+            raise
+        except Exception as e:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            if isinstance(e, OSError) and e.errno == errno.ENOSPC:
+                return _deferred(rel_path)
+            res.update(status="failed", error=str(e))
+            return res
+        res["transfer"] = None  # thông số của cả batch, điền sau khi luồng tar xong
+        res["digests"] = hasher.hexdigests() if hasher else None
+        res["local_meta"] = (member.size, int(member.mtime))
+        if versioned:
+            res.update(status="conflict_versioned", note="created versioned copy due to conflict")
+        else:
+            res["status"] = "copied_overwrite" if (existed and ON_CONFLICT == "overwrite") else "copied"
+        return res
         # ---------- end inner function ----------
 
+    def _link_dups(src_res, followers):
+        """
+        Tạo các path trùng hash từ file đã tải (src_res): hardlink, filesystem không cho
+        (khác device, không hỗ trợ, quá số link) thì copy local. Trả về list kết quả như _copy_one.
+        """
+        tname = threading.current_thread().name
+        src_local = os.path.join(dest_base, src_res["dest_rel"])
+        out = []
+        for rel_path in followers:
+            src_root, alias, orig_rel = rel_origin.get(rel_path, (None, None, rel_path))
+            dest_local_base = os.path.join(dest_base, rel_path)
+            size = remote_rel_size.get(rel_path, 0)
+            res = {
+                "rel_path": rel_path, "alias": alias, "src_root": src_root,
+                "src_remote": f"{(src_root or '').rstrip('/')}/{orig_rel}",
+                "dest_rel": os.path.relpath(dest_local_base, dest_base), "bytes": size
+            }
+            t0 = time.time()
+            try:
+                for _ in range(3):
+                    dest_local, versioned, existed = _pick_dest(
+                        rel_path, tname, dest_local_base,
+                        lambda: remote_rel_mtime.get(rel_path) or os.stat(src_local).st_mtime)
+                    if dest_local is None:
+                        break
+                    # đè file cũ (overwrite) hoặc copy local: tạo ở file tạm rồi rename, không để file dở
+                    tmp = _tmp_path(dest_local)
+                    try:
+                        if existed and not versioned:
+                            os.link(src_local, tmp)
+                            os.replace(tmp, dest_local)
+                        else:
+                            os.link(src_local, dest_local)
+                        engine = "hardlink"
+                        break
+                    except OSError as e:
+                        if e.errno == errno.EEXIST:
+                            # đích vừa xuất hiện sau lần kiểm tra: chọn lại theo ON_CONFLICT (skip/version/overwrite)
+                            dir_cache.add(dest_local)
+                            continue
+                        if e.errno not in _LINK_FALLBACK_ERRNOS:
+                            raise
+                    # filesystem không cho hardlink -> copy local; tốn chỗ như tải về nên phải giữ chỗ
+                    if not admission.try_reserve(size):
+                        engine = "deferred"
+                        break
+                    try:
+                        shutil.copy2(src_local, tmp)
+                        os.replace(tmp, dest_local)
+                    finally:
+                        admission.release(size)
+                    engine = "local_copy"
+                    break
+                else:
+                    raise OSError(errno.EEXIST, "destination keeps appearing", dest_local)
+                if dest_local is None:
+                    res["status"] = "skipped_conflict"
+                    out.append(res)
+                    continue
+                if engine == "deferred":
+                    out.append(_deferred(rel_path))
+                    continue
+                dir_cache.add(dest_local)
+            except Exception as e:
+                res.update(status="failed", error=f"link-from {src_res['rel_path']}: {e}")
+                out.append(res)
+                continue
+            res["dest_rel"] = os.path.relpath(dest_local, dest_base)
+            res["transfer"] = {"engine": engine, "seconds": round(time.time() - t0, 3),
+                               "source": src_res["rel_path"]}
+            res["digests"] = src_res.get("digests")  # cùng nội dung với file nguồn
+            res["local_meta"] = src_res.get("local_meta")  # hardlink/copy2 giữ size + mtime
+            if versioned:
+                res.update(status="conflict_versioned", note="created versioned copy due to conflict")
+            else:
+                res["status"] = "copied_overwrite" if (existed and ON_CONFLICT == "overwrite") else "copied"
+            out.append(res)
+        return out
+
+    seed_ids = None
+    synced = set()  # path đã sync_copied giữa vòng (trước khi gửi row seed của chúng)
+    mid_sync_mode = "off"
+
+    def _flush_seed_rows(durable=False):
+        """Gửi row seed cho CacheWriter. Row chỉ được ghi khi file của nó đã bền trên đĩa:
+        giữa vòng (durable=False) thì sync_copied đúng các file đó trước, nếu không crash sau
+        group commit sẽ để lại hash của file rỗng/cụt và planner không bao giờ tải lại."""
+        nonlocal seed_ids, mid_sync_mode
+        if not seed_rows:
+            return
+        if not durable:
+            paths = [os.path.join(server1_root, r[0]) for r in seed_rows]
+            mid_sync_mode = sync_copied(paths, {os.path.dirname(p) for p in paths})
+            synced.update(paths)
+        w = cache_writer()
+        if seed_ids is None:
+            seed_ids = PathIds(cache_db(), w)
+        root_id = seed_ids.root("", server1_root)
+        seed_ids.prefetch(root_id, [r[0] for r in seed_rows])
+        now, aid = _now(), _algo_id(seed_algo)
+        rows = [(root_id, *seed_ids.rel(root_id, rel), size, mtime, aid, _hash_blob(h), _hash_blob(ph), now, now)
+                for rel, size, mtime, h, ph in seed_rows]
+        w.submit(CacheDB.upsert_local_files, rows, weight=len(rows))
+        seed_rows.clear()
+
+    def _seed_local_row(rel_path, dest_rel, digests, local_meta):
+        """Ghi hash tính lúc copy vào filemeta_local (theo lô); trả verified | mismatch | unverified.
+        local_meta: (size, mtime) của file vừa ghi — đã biết lúc copy, không stat lại."""
+        if not local_meta:
+            return None
+        dest_abs = os.path.join(dest_base, dest_rel)
+        h, ph = digests
+        expected = rel_hash.get(rel_path)
+        verify = "unverified" if expected is None else ("verified" if expected == h else "mismatch")
+        if verify == "mismatch":
+            # row local vẫn ghi hash thật của bytes đã nhận; bản remote sẽ được plan lại ở vòng sau
+            print(f"⚠️  Hash mismatch: {rel_path} (remote {expected[:16]}…, copied {h[:16]}…)")
+        seed["files"] += 1
+        seed[verify] += 1
+        seed_rows.append((os.path.relpath(dest_abs, server1_root), *local_meta, h, ph))
+        if len(seed_rows) >= COPY_SEED_BATCH:
+            _flush_seed_rows()
+        return verify
+
     # Progress bar
     pbar = None
     total_tasks = len(tasks)
@@ -1083,54 +3781,192 @@ def confirm_and_merge(
         except Exception:
             pbar = None
 
+    # File nhỏ gom thành batch tar theo root (sort theo path -> cùng thư mục nằm cạnh nhau)
+    single_tasks, tar_batches = [], []
+    small_by_root = defaultdict(list)
+    for _, rel_path in fetch_tasks:
+        src_root = rel_origin.get(rel_path, (None,))[0]
+        if TAR_BATCH_ENABLED and src_root and remote_rel_size.get(rel_path, 0) < TAR_BATCH_MAX_FILE_SIZE:
+            small_by_root[src_root].append(rel_path)
+        else:
+            single_tasks.append(rel_path)
+    for src_root, rels in small_by_root.items():
+        batch, batch_bytes = [], 0
+        for rel_path in sorted(rels):
+            batch.append(rel_path)
+            batch_bytes += remote_rel_size.get(rel_path, 0)
+            if len(batch) >= TAR_BATCH_MAX_FILES or batch_bytes >= TAR_BATCH_MAX_BYTES:
+                tar_batches.append((src_root, batch))
+                batch, batch_bytes = [], 0
+        if len(batch) > 1:
+            tar_batches.append((src_root, batch))
+        else:
+            single_tasks.extend(batch)
+    if DEBUG and tar_batches:
+        print(f"[copy] {sum(len(b) for _, b in tar_batches)} small files in {len(tar_batches)} tar batches, "
+              f"{len(single_tasks)} files via SFTP")
+
+    # Lane: file >= COPY_LARGE_FILE_SIZE chạy trên executor riêng tối đa COPY_LARGE_WORKERS worker,
+    # file nhỏ/batch tar/link dùng phần còn lại -> vài file khổng lồ không chặn hàng nghìn file nhỏ.
+    # Trong mỗi lane, task xếp theo (root, thư mục remote, tên) để đọc đĩa remote theo cụm.
+    def _locality_key(rel_path):
+        src_root, _, orig_rel = rel_origin.get(rel_path, ("", None, rel_path))
+        return src_root or "", os.path.dirname(orig_rel), orig_rel
+
+    def _is_large(rel_path):
+        return remote_rel_size.get(rel_path, 0) >= COPY_LARGE_FILE_SIZE
+
+    large_tasks = sorted((r for r in single_tasks if _is_large(r)), key=_locality_key)
+    small_tasks = sorted((r for r in single_tasks if not _is_large(r)), key=_locality_key)
+    tar_batches.sort(key=lambda b: _locality_key(b[1][0]))
+    if not large_tasks:
+        large_workers = 0
+    elif not small_tasks and not tar_batches:
+        large_workers = max_workers
+    else:
+        large_workers = min(max(1, int(COPY_LARGE_WORKERS)), max(1, max_workers - 1))
+    lanes = {
+        "small": {"workers": max(1, max_workers - large_workers),
+                  "files": len(small_tasks) + sum(len(b) for _, b in tar_batches),
+                  "bytes": sum(remote_rel_size.get(r, 0) for r in small_tasks)
+                           + sum(remote_rel_size.get(r, 0) for _, b in tar_batches for r in b)},
+        "large": {"workers": large_workers, "files": len(large_tasks),
+                  "bytes": sum(remote_rel_size.get(r, 0) for r in large_tasks)},
+    }
+    if DEBUG and large_tasks:
+        print(f"[copy] lanes: small {lanes['small']['files']} files / {lanes['small']['workers']} workers, "
+              f"large {lanes['large']['files']} files / {large_workers} workers")
+
     # Thực thi song song
-    max_workers = max(1, int(MAX_WORKERS))
-    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="copy") as ex:
-        futures = [ex.submit(_copy_one, rel_path) for _, rel_path in tasks]
-
-        for fut in as_completed(futures):
-            res = fut.result()
-            rel_path = res["rel_path"]
-            status = res["status"]
-            size = res.get("bytes", 0)
-            alias = res.get("alias")
-            src_root = res.get("src_root")
-            src_remote = res.get("src_remote")
-            dest_rel = res.get("dest_rel")
-            err = res.get("error")
-            note = res.get("note")
-
-            moved_status_map[rel_path] = {
-                "status": status,
-                "source_alias": alias,
-                "origin_root": src_root,
-                "src_remote": src_remote,
-                "dest": dest_rel,
-                "bytes": size,
-                **({"error": err} if err else {}),
-                **({"note": note} if note else {}),
-            }
+    with contextlib.ExitStack() as stack:
+        ex = stack.enter_context(ThreadPoolExecutor(max_workers=lanes["small"]["workers"],
+                                                    thread_name_prefix="copy"))
+        ex_large = ex
+        if large_workers:
+            ex_large = stack.enter_context(ThreadPoolExecutor(max_workers=large_workers,
+                                                              thread_name_prefix="copy-large"))
+
+        def _submit_one(rel_path):
+            return (ex_large if _is_large(rel_path) else ex).submit(_copy_one, rel_path)
+
+        futures = [ex_large.submit(_copy_one, rel_path) for rel_path in large_tasks]
+        futures += [ex.submit(_copy_tar_batch, root, batch) for root, batch in tar_batches]
+        futures += [ex.submit(_copy_one, rel_path) for rel_path in small_tasks]
+
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                res_list = fut.result()
+                if isinstance(res_list, dict):
+                    res_list = [res_list]
+                for res in res_list:
+                    rel_path = res["rel_path"]
+                    status = res["status"]
+                    size = res.get("bytes", 0)
+                    alias = res.get("alias")
+                    src_root = res.get("src_root")
+                    src_remote = res.get("src_remote")
+                    dest_rel = res.get("dest_rel")
+                    err = res.get("error")
+                    note = res.get("note")
+                    transfer = res.get("transfer")
+
+                    moved_status_map[rel_path] = {
+                        "status": status,
+                        "source_alias": alias,
+                        "origin_root": src_root,
+                        "src_remote": src_remote,
+                        "dest": dest_rel,
+                        "bytes": size,
+                        **({"error": err} if err else {}),
+                        **({"note": note} if note else {}),
+                        **({"transfer": transfer} if transfer else {}),
+                    }
 
-            if status.startswith("copied"):
-                copied_files += 1
-                copied_bytes += size
-                print(f"✅ Copied: {rel_path} -> {dest_rel}")
-            elif status in ("skipped_conflict", "conflict_versioned"):
-                conflict_files += 1
-                conflict_bytes += size
-                print(f"⚠️  Conflict: {rel_path} -> {dest_rel} ({status})")
-            else:  # failed*
-                failed_files += 1
-                failed_bytes += size
-                if err:
-                    errors_map[rel_path] = err
-                print(f"❌ Error while copying {rel_path}: {err or status}")
+                    engine = (transfer or {}).get("engine")
+                    if engine in ("hardlink", "local_copy"):
+                        dedup["linked_files" if engine == "hardlink" else "local_copied_files"] += 1
+                        dedup["bytes_saved"] += size
+                    if status.startswith("copied"):
+                        copied_files += 1
+                        copied_bytes += size
+                        if engine in ("hardlink", "local_copy"):
+                            print(f"🔗 Linked: {rel_path} -> {dest_rel} ({engine} từ {transfer['source']})")
+                        else:
+                            print(f"✅ Copied: {rel_path} -> {dest_rel}")
+                    elif status in ("skipped_conflict", "conflict_versioned"):
+                        conflict_files += 1
+                        conflict_bytes += size
+                        print(f"⚠️  Conflict: {rel_path} -> {dest_rel} ({status})")
+                    elif status == "deferred_space":
+                        deferred_files += 1
+                        deferred_bytes += size
+                        print(f"⏸️  Deferred (disk space): {rel_path} ({_fmt_bytes(size)})")
+                    else:  # failed*
+                        failed_files += 1
+                        failed_bytes += size
+                        if err:
+                            errors_map[rel_path] = err
+                        print(f"❌ Error while copying {rel_path}: {err or status}")
+
+                    if status.startswith("copied") or status == "conflict_versioned":
+                        written.append(os.path.join(dest_base, dest_rel))
+                        digests = res.get("digests")
+                        verify = digests and _seed_local_row(rel_path, dest_rel, digests, res.get("local_meta"))
+                        if verify:
+                            moved_status_map[rel_path]["verify"] = verify
+
+                    # path trùng hash chờ file này: tải xong -> link; lỗi/skip -> path kế tiếp lên tải thay
+                    followers = dup_followers.pop(rel_path, None)
+                    if followers:
+                        if status.startswith("copied") or status == "conflict_versioned":
+                            pending.add(ex.submit(_link_dups, res, followers))
+                        elif status == "deferred_space":
+                            # không tải path nào của hash này vòng này; vòng sau plan lại cả nhóm
+                            res_list.extend(_deferred(r) for r in followers)
+                        else:
+                            dup_followers[followers[0]] = followers[1:]
+                            pending.add(_submit_one(followers[0]))
 
-            if pbar:
-                pbar.update(1)
+                if pbar:
+                    pbar.update(len(res_list))
 
     if pbar:
         pbar.close()
+    # bền dữ liệu 1 lần cho cả vòng (không fsync từng file lúc ghi), rồi mới ghi nốt row seed
+    # (các lô seed gửi giữa vòng đã tự sync file của chúng trước)
+    t_sync = time.time()
+    unsynced = [p for p in written if p not in synced]
+    sync_mode = sync_copied(unsynced, {os.path.dirname(p) for p in unsynced}) if unsynced else mid_sync_mode
+    sync_seconds = round(time.time() - t_sync, 3)
+    if DEBUG and written:
+        print(f"[copy] {sync_mode}: {len(written)} files in {sync_seconds}s "
+              f"({dir_cache.listed} dirs listed, {dir_cache.created} created)")
+    if seed["files"]:
+        _flush_seed_rows(durable=True)
+        cache_writer().flush()
+        if DEBUG:
+            print(f"[seed] filemeta_local: {seed['files']} rows ({seed['verified']} verified, "
+                  f"{seed['mismatch']} mismatch, {seed['unverified']} unverified)")
+    pool_stats = pool.stats()
+    pool.close()
+    if DEBUG and len(pool_stats) > 1:
+        for i, st in enumerate(pool_stats):
+            print(f"[ssh-pool] transport {i}: {st['files']} files, {st['reconnects']} reconnects")
+    wire_stats = wire.stats()
+    if DEBUG and wire_stats["files"]:
+        print(f"[wire] zstd: {wire_stats['files']} files, {wire_stats['raw_bytes']} -> {wire_stats['wire_bytes']} bytes")
+    scheduler_stats = {"lanes": lanes, **throttle.stats(),
+                       "admission": {**admission.stats(), "deferred_files": deferred_files,
+                                     "deferred_bytes": deferred_bytes}}
+    if deferred_files:
+        print(f"⏸️ Deferred {deferred_files} files ({_fmt_bytes(deferred_bytes)}) to next cycle — "
+              f"target free space below planned + margin {_fmt_bytes(admission.margin)}")
+    if DEBUG and (throttle.rate or throttle.max_inflight):
+        print(f"[copy] throttle: waited {scheduler_stats['bandwidth_wait_seconds']}s on bandwidth, "
+              f"{scheduler_stats['inflight_wait_seconds']}s on in-flight bytes "
+              f"(peak {scheduler_stats['peak_inflight_bytes']})")
 
     duration = round(time.time() - start_time, 3)
     throughput = round((copied_bytes / duration), 3) if duration > 0 else 0.0
@@ -1144,8 +3980,18 @@ def confirm_and_merge(
         "failed_bytes": failed_bytes,
         "conflict_files": conflict_files,
         "conflict_bytes": conflict_bytes,
+        "deferred_files": deferred_files,
+        "deferred_bytes": deferred_bytes,
         "duration_seconds": duration,
-        "throughput_bytes_per_second": throughput
+        "throughput_bytes_per_second": throughput,
+        "ssh_pool": pool_stats,
+        "wire_compression": wire_stats,
+        "dedup": dedup,
+        "seed_local_cache": seed,
+        "scheduler": scheduler_stats,
+        "durability": {"mode": sync_mode, "seconds": sync_seconds, "files": len(written),
+                       "dirs_listed": dir_cache.listed, "dirs_created": dir_cache.created,
+                       "stale_tmp_removed": dir_cache.swept},
     })
     save_json_log(
         json_log_path,
@@ -1164,7 +4010,8 @@ def confirm_and_merge(
         copied_files, copied_bytes,
         failed_files, failed_bytes,
         conflict_files, conflict_bytes,
-        server1_root, run_id, server2_roots, aliases
+        server1_root, run_id, server2_roots, aliases,
+        scheduler_stats=scheduler_stats
     )
     _save_snapshot(
         os.path.join(logs_dir, "_state.json"),
@@ -1178,6 +4025,8 @@ def confirm_and_merge(
         "bytes_copied": copied_bytes,
         "bytes_failed": failed_bytes,
         "bytes_conflict": conflict_bytes,
+        "deferred": deferred_files,
+        "bytes_deferred": deferred_bytes,
         "planned_files": planned_files,
         "planned_bytes": planned_bytes,
         "json_log": json_log_path,
@@ -1229,7 +4078,7 @@ def conflict_version_path(dest_local: str, ts_epoch: int | None = None) -> str:
         i += 1
 
 def _write_metrics_end(planned_stats, copied_files, copied_bytes, failed_files, failed_bytes, conflict_files, conflict_bytes,
-                       server1_root, run_id, roots, aliases):
+                       server1_root, run_id, roots, aliases, scheduler_stats=None):
     fs = fs_usage_metrics(server1_root)
     metric_lines = [
         "# HELP merge_unique_files_total Number of unique files only available on server2 (planned).",
@@ -1268,6 +4117,47 @@ def _write_metrics_end(planned_stats, copied_files, copied_bytes, failed_files,
     metric_lines.append(build_metric_line("merge_files_conflict_total", conflict_files, base_labels))
     metric_lines.append(build_metric_line("merge_bytes_conflict_total", conflict_bytes, base_labels))
     metric_lines.append(build_metric_line("merge_last_run_timestamp_seconds", int(time.time()), base_labels))
+    if scheduler_stats:
+        metric_lines += [
+            "# HELP merge_copy_lane_files Files scheduled per copy lane.",
+            "# TYPE merge_copy_lane_files gauge",
+            "# HELP merge_copy_lane_bytes Bytes scheduled per copy lane.",
+            "# TYPE merge_copy_lane_bytes gauge",
+            "# HELP merge_copy_lane_workers Workers per copy lane.",
+            "# TYPE merge_copy_lane_workers gauge",
+            "# HELP merge_copy_bandwidth_limit_bytes_per_second Configured copy bandwidth cap (0 = unlimited).",
+            "# TYPE merge_copy_bandwidth_limit_bytes_per_second gauge",
+            "# HELP merge_copy_bandwidth_wait_seconds Time copy jobs slept on the bandwidth token bucket.",
+            "# TYPE merge_copy_bandwidth_wait_seconds gauge",
+            "# HELP merge_copy_inflight_limit_bytes Configured max bytes in flight (0 = unlimited).",
+            "# TYPE merge_copy_inflight_limit_bytes gauge",
+            "# HELP merge_copy_inflight_peak_bytes Peak bytes in flight during the run.",
+            "# TYPE merge_copy_inflight_peak_bytes gauge",
+            "# HELP merge_copy_inflight_wait_seconds Time copy jobs waited for the in-flight byte budget.",
+            "# TYPE merge_copy_inflight_wait_seconds gauge",
+            "# HELP merge_copy_deferred_files Files deferred to the next cycle for lack of target disk space.",
+            "# TYPE merge_copy_deferred_files gauge",
+            "# HELP merge_copy_deferred_bytes Bytes deferred to the next cycle for lack of target disk space.",
+            "# TYPE merge_copy_deferred_bytes gauge",
+            "# HELP merge_copy_disk_margin_bytes Free space kept in reserve on the target filesystem.",
+            "# TYPE merge_copy_disk_margin_bytes gauge",
+        ]
+        for lane, st in scheduler_stats["lanes"].items():
+            labels = {**base_labels, "lane": lane}
+            metric_lines.append(build_metric_line("merge_copy_lane_files", st["files"], labels))
+            metric_lines.append(build_metric_line("merge_copy_lane_bytes", st["bytes"], labels))
+            metric_lines.append(build_metric_line("merge_copy_lane_workers", st["workers"], labels))
+        for name, key in (("merge_copy_bandwidth_limit_bytes_per_second", "bandwidth_limit_bps"),
+                          ("merge_copy_bandwidth_wait_seconds", "bandwidth_wait_seconds"),
+                          ("merge_copy_inflight_limit_bytes", "max_inflight_bytes"),
+                          ("merge_copy_inflight_peak_bytes", "peak_inflight_bytes"),
+                          ("merge_copy_inflight_wait_seconds", "inflight_wait_seconds")):
+            metric_lines.append(build_metric_line(name, scheduler_stats[key], base_labels))
+        adm = scheduler_stats["admission"]
+        for name, key in (("merge_copy_deferred_files", "deferred_files"),
+                          ("merge_copy_deferred_bytes", "deferred_bytes"),
+                          ("merge_copy_disk_margin_bytes", "margin_bytes")):
+            metric_lines.append(build_metric_line(name, adm[key], base_labels))
     write_prometheus_metrics(TEXTFILE_COLLECTOR_DIR, PROM_METRIC_BASENAME, metric_lines)
 
 # ===================== Snapshot (change detection) =====================
@@ -1291,7 +4181,7 @@ def _should_run_scrub(now_dt):
         return False
     return now_dt.hour == SCRUB_AT_HOUR and now_dt.minute == SCRUB_AT_MIN
 
-def _pick_random_rows(db, table, where, limit, percent):
+def _pick_random_rows(db, table, where, limit, percent, cols="rowid, *"):
     sql_count = f"SELECT COUNT(*) FROM {table} {where}"
     cnt = db.execute(sql_count).fetchone()[0]
     if cnt == 0:
@@ -1301,45 +4191,46 @@ def _pick_random_rows(db, table, where, limit, percent):
     else:
         n = max(1, int(cnt * percent))
     # randomize using ORDER BY RANDOM() — ok for moderate
-    sql_pick = f"SELECT rowid, * FROM {table} {where} ORDER BY RANDOM() LIMIT {n}"
+    sql_pick = f"SELECT {cols} FROM {table} {where} ORDER BY RANDOM() LIMIT {n}"
     return db.execute(sql_pick).fetchall()
 
 def run_scrub_local(root, algo):
-    db_init()
-    with sqlite3.connect(CACHE_DB) as db:
-        rows = _pick_random_rows(db, "filemeta_local",
-                                 f"WHERE root='{root}' AND algo='{algo}'",
-                                 SCRUB_LIMIT_LOCAL, SCRUB_PERCENT_LOCAL)
-        if not rows:
-            return 0
-        now = _now()
-        ok = 0
-        for r in rows:
-            rel = r[2]  # root,rel,size,mtime...
-            full = os.path.join(root, rel)
-            try:
-                h = compute_hash_local(full, algo)
-            except Exception:
-                h = None
-            db.execute("""UPDATE filemeta_local SET hash=?, last_hashed=?, last_seen=?
-                          WHERE root=? AND rel=? AND algo=?""",
-                       (h, now if h else None, now, root, rel, algo))
-            ok += 1
-        db.commit()
-        return ok
+    w = cache_writer()
+    w.flush()
+    rows = _pick_random_rows(cache_db(), "filemeta_local f JOIN path_dir d ON d.id=f.dir_id",
+                             f"WHERE f.root_id=(SELECT id FROM path_root WHERE host='' AND root='{root}') "
+                             f"AND f.algo={_algo_id(algo)}",
+                             SCRUB_LIMIT_LOCAL, SCRUB_PERCENT_LOCAL,
+                             cols=f"f.dir_id, f.name, {_rel_sql('f')}")
+    if not rows:
+        return 0
+    now = _now()
+    results = []
+    pool = LocalHashPool(algo, label="scrub-local")
+    try:
+        for dir_id, name, rel in rows:
+            results.extend(pool.submit((dir_id, name), os.path.join(root, rel)))
+        results.extend(pool.drain())
+    finally:
+        pool.close()
+    w.submit(CacheDB.set_local_hashes,
+             [(_hash_blob(h), _hash_blob(ph), now if h else None, now, dir_id, name, _algo_id(algo))
+              for (dir_id, name), h, ph in results], weight=len(results))
+    w.flush()
+    return len(results)
 
 def run_scrub_remote(ssh_client, host, roots, algo):
-    db_init()
-    with sqlite3.connect(CACHE_DB) as db:
-        rows = _pick_random_rows(db, "filemeta_remote",
-                                 f"WHERE host='{host}' AND algo='{algo}'",
-                                 SCRUB_LIMIT_REMOTE, SCRUB_PERCENT_REMOTE)
+    cache_writer().flush()
+    with cache_db() as db:
+        rows = _pick_random_rows(db, "filemeta_remote f JOIN path_dir d ON d.id=f.dir_id "
+                                     "JOIN path_root pr ON pr.id=f.root_id",
+                                 f"WHERE pr.host='{host}' AND f.algo={_algo_id(algo)}",
+                                 SCRUB_LIMIT_REMOTE, SCRUB_PERCENT_REMOTE,
+                                 cols=f"pr.root, {_rel_sql('f')}, f.size")
     # gom theo root
     by_root = defaultdict(list)
-    for row in rows:
-        # row format: rowid, host, root, rel, size, mtime, algo, hash, last_seen, last_hashed
-        root = row[2]; rel = row[3]
-        by_root[root].append((rel, row[4]))
+    for root, rel, size in rows:
+        by_root[root].append((rel, size))
     # hash batch tương tự remote batch
     total = 0
     for root, rels in by_root.items():
@@ -1376,17 +4267,24 @@ def one_shot(run_id, auto_merge=True):
     # 2) Remote: refresh metadata (last_seen = cycle_ts)
     refresh_remote_metadata(client2, SERVER2_HOST, SERVER2_ROOTS, algo)
 
-    #3) Remote: hash by budget
+    #3) Remote: partial hash (tier rẻ) cho file lớn trùng size, rồi full hash by budget
+    partial_list = _choose_remote_to_partial_hash(SERVER2_HOST, algo, SERVER1_ROOT, REMOTE_PARTIAL_BUDGET_FILES)
+    if partial_list:
+        phashed = hash_remote_batch(client2, SERVER2_HOST, algo, partial_list, partial=True)
+        if phashed:
+            print(f"🌐 Remote partial-hashed this round: {phashed} file")
     budget_list = _choose_remote_to_hash_budget(SERVER2_HOST, SERVER2_ROOTS, algo,
-                                                REMOTE_HASH_BUDGET_FILES, REMOTE_HASH_BUDGET_BYTES)
+                                                REMOTE_HASH_BUDGET_FILES, REMOTE_HASH_BUDGET_BYTES,
+                                                local_root=SERVER1_ROOT)
     if budget_list:
         hashed_remote = hash_remote_batch(client2, SERVER2_HOST, algo, budget_list)
         if hashed_remote:
             print(f"🌐 Remote hashed this round: {hashed_remote} file")
 
     # 4) Planned: only use “just seen” records in this round
-    hashes2, only_in_2, remote_rel_size, rel_origin, planned_stats = compute_planned(
-        SERVER1_ROOT, SERVER2_HOST, SERVER2_ROOTS, algo, min_last_seen=cycle_ts
+    hashes2, only_in_2, remote_rel_size, rel_origin, planned_stats, remote_rel_mtime = compute_planned(
+        SERVER1_ROOT, SERVER2_HOST, SERVER2_ROOTS, algo, min_last_seen=cycle_ts,
+        local_min_last_seen=local_cache_valid_since(SERVER1_ROOT, cycle_ts)
     )
 
     # summary of planned results
@@ -1410,7 +4308,7 @@ def one_shot(run_id, auto_merge=True):
     summary = confirm_and_merge(
         SERVER1_ROOT, client2, SERVER2_ROOTS, aliases,
         hashes2, only_in_2, remote_rel_size, rel_origin, planned_stats, run_id,
-        auto=auto_merge
+        auto=auto_merge, algo=algo, remote_rel_mtime=remote_rel_mtime
     )
 
     try: client2.close()
@@ -1480,6 +4378,9 @@ def main():
             time.sleep(SLEEP_SECONDS)
     except KeyboardInterrupt:
         print("\n👋 Stop at user request.")
+    finally:
+        if _cache_writer is not None:
+            _cache_writer.close()
 
 if __name__ == "__main__":
     # Với chế độ daemon, giữ tqdm gọn (leave=False đã set trong từng tqdm)